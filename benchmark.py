@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.worksheet.table import Table
+
+import distribute
+import raw_store
+import schema
+import table_parser
+
+"""
+Synthetic-scale benchmarks for the scrape-parse and distribute pipeline, no browser or real data needed.
+For every row count it generates Canvas Catalog style analytics pages (with the real data-testid columns), raw user data,
+processed_data.xlsx and one registration excel per program in distribute.EXCELS (HEADER_ROW header, an excel table and session sheets),
+then times each stage and reports the wall time, rows/sec and peak memory.
+Results are saved as JSON, pass an older results file with --compare to see regressions between versions.
+
+Example: python benchmark.py --rows 1000 10000 --stages parse convert store
+"""
+
+STAGES = ['parse', 'convert', 'store', 'distribute']
+
+SESSIONS = ['2023 Fall', '2024 Spring', '2024 Summer']
+REGISTRATION_HEADERS = [
+    'Full Name', 'Email Address', 'Organization', 'Title', 'Phone Number', 'Mailing Address',
+    'Self-Identify as Indigenous?', 'Received FSG?', 'Grant Amount Received', 'Notes'
+]
+FIRST_NAMES = ['Ava', 'Liam', 'Noah', 'Emma', 'Olivia', 'Lucas', 'Mia', 'Ethan', 'Zoë', 'Mateo', 'Chloé', "D'Arcy"]
+LAST_NAMES = ['Smith', 'Nguyen', 'Singh', 'Tremblay', 'Wong', 'Martin', 'Roy', "O'Brien", 'Lévesque', 'Chen-Li']
+
+# Rows on each generated analytics page, the tables in Canvas Catalog show 100 rows a page
+PAGE_SIZE = 100
+
+def synthetic_enrollments(row_count, seed):
+    """ One dict per enrollment with what the analytics table shows, emails repeat so some land on existing rows """
+    rng = random.Random(seed)
+    codes = list(distribute.EXCELS)
+    enrollments = []
+    for i in range(row_count):
+        user_id = rng.randrange(max(row_count // 2, 1))
+        code = rng.choice(codes)
+        enrollments.append({
+            'name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            'user_id': 10000 + user_id,
+            'email': f"user{user_id}@example.com",
+            'code': code,
+            'listing': f"{code} - Online Micro-Certificate: {distribute.EXCELS[code].split(' - ')[0]} {rng.choice(SESSIONS)}",
+            'listing_id': 100000 + rng.randrange(5000),
+            'status': rng.choice(['Active', 'Completed', 'Concluded', 'Dropped']),
+            'enrolled_at': f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+            'price': rng.choice(['0', '250.00', '1,200.00']),
+        })
+    return enrollments
+
+def enrollment_row_html(enrollment):
+    """ One <tr> marked up like the analytics page, including the truncated name/listing spans and screen reader content """
+    return (
+        '<tr class="css-row">'
+        f'<td data-testid="student_name"><a href="#"><span aria-label="{enrollment["name"]}">{enrollment["name"]}</span></a>'
+        f'<div><span>#{enrollment["user_id"]} | {enrollment["email"]}</span></div></td>'
+        f'<td data-testid="account_name"><span>{enrollment["code"]} - Online Micro-Certificate</span></td>'
+        f'<td data-testid="product_name"><span aria-label="{enrollment["listing"]}">{enrollment["listing"][:30]}…</span>'
+        f'<span class="css-1sr7vfn-screenReaderContent">{enrollment["listing"]}</span><span>{enrollment["listing_id"]}</span></td>'
+        f'<td data-testid="enrollment_state"><span>{enrollment["status"]}</span></td>'
+        f'<td data-testid="created_at"><span>{enrollment["enrolled_at"]}</span></td>'
+        f'<td data-testid="price"><span>{enrollment["price"]}</span></td>'
+        '</tr>'
+    )
+
+def enrollment_pages(enrollments):
+    """ The enrollments split into analytics pages of PAGE_SIZE rows """
+    pages = []
+    for start in range(0, len(enrollments), PAGE_SIZE):
+        rows = ''.join(enrollment_row_html(enrollment) for enrollment in enrollments[start:start + PAGE_SIZE])
+        pages.append(
+            '<html><head><title>Analytics</title></head><body><div id="app"><main>'
+            '<div data-automation="Filter__Show__Filters__Button"></div>'
+            '<table><thead><tr><th>Name</th><th>Program</th><th>Listing</th><th>Status</th><th>Enrolled</th><th>Price</th></tr></thead>'
+            f'<tbody>{rows}</tbody></table>'
+            '<div data-automation="Pagination"><ul><li><button aria-current="page">1</button></li><li><button>2</button></li></ul></div>'
+            '</main></div></body></html>'
+        )
+    return pages
+
+def synthetic_users(enrollments):
+    """ user_data rows for the enrollments' users, like the users analytics table """
+    users = {}
+    for enrollment in enrollments:
+        users[enrollment['email']] = {
+            'student_name_0': enrollment['name'],
+            'student_name_1': f"#{enrollment['user_id']} | {enrollment['email']}",
+            'custom_fields_organization': f"Organization {enrollment['user_id'] % 97}",
+            'custom_fields_title': 'Forester',
+            'custom_fields_phone-number': f"604-555-{enrollment['user_id'] % 10000:04d}",
+            'custom_fields_mailing-address': f"{enrollment['user_id']} Main St, Vancouver BC",
+            'custom_fields_indigenous-self-declaration': enrollment['user_id'] % 2,
+        }
+    return pd.DataFrame(list(users.values()))
+
+def synthetic_grants(enrollments):
+    """ processed_data rows for about a third of the users """
+    emails = sorted({enrollment['email'] for enrollment in enrollments})
+    return pd.DataFrame({'Email': emails[::3], 'Grant amount to give': [1000] * len(emails[::3])})
+
+def write_registration_excels(folder, existing_rows, seed):
+    """ One registration excel per program in EXCELS, each session sheet has the header on HEADER_ROW, existing rows and an excel table """
+    rng = random.Random(seed)
+    for code, filename in distribute.EXCELS.items():
+        workbook = Workbook()
+        workbook.remove(workbook.active)
+        for session in SESSIONS:
+            sheet = workbook.create_sheet(session)
+            sheet.cell(row=1, column=1, value=f"{code} {session} Registrations")
+            for col_index, header in enumerate(REGISTRATION_HEADERS, start=1):
+                sheet.cell(row=distribute.HEADER_ROW, column=col_index, value=header)
+            for row in range(distribute.HEADER_ROW + 1, distribute.HEADER_ROW + 1 + existing_rows):
+                user_id = rng.randrange(10 ** 6, 2 * 10 ** 6)
+                sheet.cell(row=row, column=1, value=f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}")
+                sheet.cell(row=row, column=2, value=f"existing{user_id}@example.com")
+                sheet.cell(row=row, column=3, value=f"Organization {user_id % 97}")
+
+            last_row = max(distribute.HEADER_ROW + existing_rows, distribute.HEADER_ROW + 1)
+            last_column = sheet.cell(row=distribute.HEADER_ROW, column=len(REGISTRATION_HEADERS)).column_letter
+            sheet.add_table(Table(displayName=f"{code}_{session.replace(' ', '_')}", ref=f"A{distribute.HEADER_ROW}:{last_column}{last_row}"))
+        workbook.save(os.path.join(folder, filename))
+
+def measure(stage, rows, func, trace_memory):
+    """ Run func once and return its timings, console output from the pipeline is hidden so it doesn't skew the timing """
+    if trace_memory:
+        tracemalloc.start()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        result = func()
+    seconds = time.perf_counter() - start_wall
+    cpu_seconds = time.process_time() - start_cpu
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    report = {
+        'stage': stage,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'cpu_seconds': round(cpu_seconds, 4),
+        'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_memory_mb': round(peak / 2 ** 20, 2) if peak is not None else None,
+    }
+    print(f"{stage:>22} {rows:>8} rows {report['seconds']:>10.3f}s {report['rows_per_sec'] or 0:>12.1f} rows/s "
+          f"{report['peak_memory_mb'] if peak is not None else '-':>8} MB")
+    return (result, report)
+
+def run_scale(row_count, stages, args):
+    """ Generate the inputs for row_count rows and benchmark each stage on them """
+    reports = []
+    enrollments = synthetic_enrollments(row_count, args.seed)
+    pages = enrollment_pages(enrollments)
+
+    with tempfile.TemporaryDirectory() as folder:
+        # Every stage needs the parsed rows, but only compare the html parsers when the parse stage was asked for
+        backends = [args.backend or table_parser.DEFAULT_BACKEND]
+        if 'parse' in stages and not args.backend:
+            backends = [name for name, table_cells in table_parser.BACKENDS.items() if table_cells is not None]
+        for backend in backends:
+            (rows, report) = measure(f'parse[{backend}]', row_count, lambda: table_parser.parse_pages(pages, backend), args.memory)
+            if 'parse' in stages:
+                reports.append(report)
+
+        df_enrollment = pd.DataFrame(rows)
+        (df_enrollment, report) = measure('convert', row_count, lambda: schema.apply_schema(df_enrollment, raw_store.ENROLLMENTS), args.memory)
+        if 'convert' in stages:
+            reports.append(report)
+
+        # Keep the store and raw excels inside the temp folder so the real ones are never touched
+        raw_store.RAW_DATA_STORE_PATH = os.path.join(folder, 'raw_data.sqlite')
+        raw_store.EXCEL_PATHS = {table: os.path.join(folder, f'{table}.xlsx') for table in raw_store.EXCEL_PATHS}
+        if 'store' in stages:
+            (_, report) = measure('store[new rows]', row_count, lambda: raw_store.append_rows(raw_store.ENROLLMENTS, df_enrollment), args.memory)
+            reports.append(report)
+            (_, report) = measure('store[all duplicates]', row_count, lambda: raw_store.append_rows(raw_store.ENROLLMENTS, df_enrollment), args.memory)
+            reports.append(report)
+
+        if 'distribute' in stages:
+            registrations_folder = os.path.join(folder, 'registrations') + os.sep
+            os.makedirs(registrations_folder)
+            write_registration_excels(registrations_folder, args.existing_rows, args.seed)
+            raw_store.append_rows(raw_store.USERS, synthetic_users(enrollments))
+            grants_path = os.path.join(folder, 'processed_data.xlsx')
+            synthetic_grants(enrollments).to_excel(grants_path, index=False)
+
+            distribute.REGISTRATIONS_FOLDER_PATH = registrations_folder
+            os.environ['ENROLLMENTS_HISTORY_PATH'] = os.path.join(folder, 'enrollments.xlsx')
+            os.environ['INPUT_CACHE_PATH'] = os.path.join(folder, '.input_cache')
+            (_, report) = measure(f'distribute[workers={args.workers}]', row_count, lambda: distribute.distribute_enrollment_data(df_enrollment, grants_path, args.workers), args.memory)
+            reports.append(report)
+            (_, report) = measure('distribute[rerun]', row_count, lambda: distribute.distribute_enrollment_data(df_enrollment, grants_path, args.workers), args.memory)
+            reports.append(report)
+
+    return reports
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous_path):
+    """ Print how each stage's rows/sec changed compared to an older results file """
+    with open(previous_path) as f:
+        previous = {(report['stage'], report['rows']): report for report in json.load(f)['results']}
+
+    print(f"\nCOMPARED TO {previous_path}")
+    for report in results:
+        old = previous.get((report['stage'], report['rows']))
+        if old and old['rows_per_sec'] and report['rows_per_sec']:
+            change = (report['rows_per_sec'] / old['rows_per_sec'] - 1) * 100
+            flag = "  <-- SLOWER" if change < -10 else ""
+            print(f"{report['stage']:>22} {report['rows']:>8} rows {change:>+8.1f}% rows/s{flag}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scrape-parse and distribute pipeline on synthetic data')
+    parser.add_argument('--rows', nargs='+', type=int, default=[1000, 10000], help='Row counts to benchmark, from 1k up to 500k. Example: --rows 1000 100000. Defaults to 1000 10000')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to benchmark. Defaults to all stages')
+    parser.add_argument('--backend', choices=list(table_parser.BACKENDS), help='Only benchmark this html parser. Defaults to every installed parser')
+    parser.add_argument('--existing-rows', type=int, default=200, help='Rows already in each registration sheet. Defaults to 200')
+    parser.add_argument('--workers', type=int, default=1, help='Passed to distribute_enrollment_data. Defaults to 1')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="Don't trace peak memory, tracing slows down allocation heavy stages")
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data so runs are comparable. Defaults to 0')
+    parser.add_argument('--output', default=distribute.add_date_to_filename('benchmark.json'), help='Where to save the results JSON. Defaults to benchmark_<date>.json')
+    parser.add_argument('--compare', metavar='RESULTS_JSON', help='Older results file to compare rows/sec against')
+    args = parser.parse_args()
+
+    results = []
+    for row_count in args.rows:
+        print(f"\nBENCHMARKING {row_count} ROWS")
+        results.extend(run_scale(row_count, args.stages, args))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': git_revision(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'results': results,
+        }, f, indent=2)
+    print("\nSAVED BENCHMARK RESULTS TO", args.output)
+
+    if args.compare:
+        compare(results, args.compare)
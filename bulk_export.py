@@ -0,0 +1,151 @@
+import os
+import re
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+import instrumentation
+import raw_store
+
+load_dotenv()
+
+"""
+Bulk export of the analytics tables over HTTP instead of clicking through every page of the table in the browser.
+After login the browser's cookies are copied into a pooled requests.Session, then the data the analytics pages render is requested
+in large pages, a few at a time.
+
+The endpoints are set in .env since they are whatever the analytics pages load their data from (look in the browser's network tab).
+Each endpoint is called with page and per_page parameters and must return JSON,
+either a list of rows or an object with the rows under "data", "rows" or "results". Each row is keyed by the table column's data-testid
+with the text the cell shows, so the rows go through the same column rules as the scraped table (see table_parser.rows_from_cells).
+The number of pages is read from a Link header (rel="last"), a "total_pages"/"meta.total_pages" field, or found by stopping at the first page shorter than the first one.
+The analytics filters live in the page, not in its url or the export request, so the course and status filters are applied to the exported rows.
+"""
+
+EXPORT_URLS = {
+    raw_store.ENROLLMENTS: os.environ.get("ANALYTICS_EXPORT_URL_ENROLLMENTS"),
+    raw_store.USERS: os.environ.get("ANALYTICS_EXPORT_URL_USERS"),
+}
+
+# Rows requested per page and how many pages are requested at the same time
+PAGE_SIZE = 1000
+MAX_CONCURRENT_REQUESTS = 4
+
+LAST_PAGE_PATTERN = re.compile(r'<([^>]+)>;\s*rel="last"')
+
+class BulkExportError(Exception):
+    """ The bulk export couldn't be used, the caller should fall back to scraping the table """
+
+def session_from_driver(driver, pool_size=MAX_CONCURRENT_REQUESTS):
+    """ A requests.Session logged in with the browser's cookies, with a connection pool big enough for the concurrent requests """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+    session.headers['User-Agent'] = driver.execute_script("return navigator.userAgent")
+    session.headers['Accept'] = 'application/json'
+    return session
+
+# Column of the exported enrollments each filter of get_data.scrape_filters is checked against
+FILTER_COLUMNS = {'courses': 'account_name', 'status': 'enrollment_state'}
+
+def row_matches(row, filters):
+    """ The program code is the first word of the account, like distribute reads it, and statuses are compared without case """
+    for key, values in filters.items():
+        column = FILTER_COLUMNS[key]
+        if column not in row:
+            raise BulkExportError(f"Can't filter the export by {key}, the rows have no {column} column")
+        value = str(row[column] or '')
+        if key == 'courses':
+            value = value.split(' ')[0]
+        if value.lower() not in {wanted.lower() for wanted in values}:
+            return False
+    return True
+
+def filter_rows(rows, filters):
+    """ The rows that match the filters the table would have been scraped with """
+    return [row for row in rows if row_matches(row, filters)] if filters else rows
+
+def response_rows(data):
+    """ The rows in an export response """
+    if isinstance(data, list):
+        return data
+    for key in ('data', 'rows', 'results'):
+        if isinstance(data.get(key), list):
+            return data[key]
+    raise BulkExportError(f"Couldn't find the rows in the response, expected a list or one of data/rows/results. Got keys {list(data)}")
+
+def response_total_pages(response, data):
+    """ Total number of pages if the response says so, None otherwise """
+    match = LAST_PAGE_PATTERN.search(response.headers.get('Link', ''))
+    if match:
+        last_page = dict(parse_qsl(urlsplit(match.group(1)).query)).get('page')
+        if last_page and last_page.isdigit():
+            return int(last_page)
+
+    if isinstance(data, dict):
+        total_pages = data.get('total_pages') or (data.get('meta') or {}).get('total_pages')
+        if total_pages is not None:
+            return int(total_pages)
+    return None
+
+def fetch_page(session, url, page):
+    """ Returns (rows, total pages or None) for one page of the export """
+    instrumentation.count('bulk_export_requests')
+    try:
+        response = session.get(url, params={'page': page, 'per_page': PAGE_SIZE}, timeout=60)
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise BulkExportError(f"Request for page {page} of {url} failed: {e}") from e
+
+    return (response_rows(data), response_total_pages(response, data))
+
+def rows_to_cells(rows):
+    """ Turn export rows into the same cells EXTRACT_TABLE_SCRIPT collects, so they can go through extract_table_data in script mode """
+    return [[(label, '' if value is None else str(value), [], None) for label, value in row.items()] for row in rows]
+
+def export_pages(session, table, filters=None):
+    """
+    Fetch the whole table and return the rows that match filters (get_data.scrape_filters of the table) as a list of ('script', cells) pages,
+    like get_data.live_pages. Everything is fetched before returning so a failure part way through can still fall back to scraping.
+    """
+    url = EXPORT_URLS.get(table)
+    if not url:
+        raise BulkExportError(f"No export url set for {table} in .env")
+
+    (rows, total_pages) = fetch_page(session, url, 1)
+    pages = [rows]
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        if total_pages is not None:
+            pages.extend(rows for (rows, _) in executor.map(lambda page: fetch_page(session, url, page), range(2, total_pages + 1)))
+        else:
+            # Unknown number of pages, fetch MAX_CONCURRENT_REQUESTS pages at a time until a page is shorter than the first one.
+            # The server can cap per_page below PAGE_SIZE, so a full page is as long as the first page
+            full_page = len(rows)
+            next_page = 2
+            while len(pages[-1]) >= full_page > 0:
+                batch = range(next_page, next_page + MAX_CONCURRENT_REQUESTS)
+                for (rows, _) in executor.map(lambda page: fetch_page(session, url, page), batch):
+                    # Without this an endpoint that ignores the page parameter would be fetched forever
+                    if rows == pages[0]:
+                        raise BulkExportError(f"{url} returned the first page again, it doesn't seem to take a page parameter")
+                    pages.append(rows)
+                    if len(rows) < full_page:
+                        break
+                next_page += MAX_CONCURRENT_REQUESTS
+
+    print(f"EXPORTED {sum(len(rows) for rows in pages)} {table} ROWS IN {len(pages)} REQUESTS")
+    pages = [filter_rows(rows, filters) for rows in pages]
+    return [('script', rows_to_cells(rows)) for rows in pages if len(rows) > 0]
@@ -0,0 +1,80 @@
+import os
+import shutil
+from glob import glob
+from datetime import datetime
+from dotenv import load_dotenv
+
+import json_files
+import raw_store
+import snapshots
+
+load_dotenv()
+
+"""
+Checkpoint of the run in progress, so a run that fails part way (login timeout, a stale element while paging, an error while distributing...)
+can be picked up with get_data.py --resume instead of starting again.
+Every scraped page is saved as a snapshot in the checkpoint folder as soon as it's read and run.json has the filters of the run,
+which tables were scraped to the end and the run id of its distribution history. The excels don't need anything here, each one records
+its rows in the distribution ledger as soon as it's saved so a resumed run skips them. The checkpoint is deleted when a run finishes.
+"""
+
+STATE_FILE = "run.json"
+
+def folder():
+    """ CHECKPOINT_PATH, or a checkpoint folder next to the raw data store """
+    return os.environ.get("CHECKPOINT_PATH") or os.path.join(os.path.dirname(raw_store.RAW_DATA_STORE_PATH), "checkpoint")
+
+def load_state():
+    return json_files.read_json(os.path.join(folder(), STATE_FILE))
+
+def save_state(state):
+    json_files.write_json(os.path.join(folder(), STATE_FILE), state)
+
+def clear():
+    """ Delete the checkpoint, called when a run finished """
+    shutil.rmtree(folder(), ignore_errors=True)
+
+def start(filters, resume):
+    """
+    The state of the run: the checkpoint of the last run if resume is set and it has the same filters, otherwise a new checkpoint
+    (any old one is deleted).
+    """
+    state = load_state()
+    if resume:
+        if state is not None and state['filters'] == filters:
+            print(f"RESUMING THE RUN STARTED {state['started_at']}")
+            return state
+        print("NO CHECKPOINT WITH THE SAME FILTERS TO RESUME, STARTING A NEW RUN")
+
+    clear()
+    os.makedirs(folder(), exist_ok=True)
+    started_at = datetime.now()
+    state = {
+        'filters': filters,
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'run_id': started_at.strftime('%Y%m%d_%H%M%S'),
+        'finished_tables': [],
+    }
+    save_state(state)
+    return state
+
+def page_count(table):
+    """ How many pages of the table are saved """
+    return len(glob(os.path.join(folder(), f"{table}_*.json.gz")))
+
+def table_finished(state, table):
+    return table in state['finished_tables']
+
+def saved_pages(table):
+    """ Yields (extract_mode, payload) for every saved page of the table, in the order they were scraped """
+    if page_count(table) > 0:
+        yield from snapshots.load_pages(folder(), table)
+
+def save_pages(state, table, pages):
+    """ Pass the pages through, saving each one before it's used. Once they run out the table is marked as finished """
+    for (extract_mode, payload) in pages:
+        snapshots.save_page(folder(), table, page_count(table) + 1, extract_mode, payload)
+        yield (extract_mode, payload)
+
+    state['finished_tables'].append(table)
+    save_state(state)
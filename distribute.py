@@ -1,10 +1,16 @@
-from openpyxl import load_workbook
 import pandas as pd
 from dotenv import load_dotenv
 import os
 from datetime import datetime
 import re
 import traceback
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import input_cache
+import instrumentation
+import raw_store
+import xlsx_fast
 
 load_dotenv()
 
@@ -62,91 +68,246 @@ Grant amount to give -> Received FSG?, Grant Amount
 4. Append the data to the end of the sheet, or write to the exiting row
 """
 
-def extract_user_data(row, user_data_row, user_grant_row):
-    """ This puts combines the data from the various sheets into the format we want """
+# Columns pulled from user_data and processed_data for each enrollment, prefixed when joined so they can't clash with enrollment columns
+USER_DATA_COLUMNS = [
+    'custom_fields_organization',
+    'custom_fields_title',
+    'custom_fields_phone-number',
+    'custom_fields_mailing-address',
+    'custom_fields_indigenous-self-declaration'
+]
+GRANT_DATA_COLUMNS = ['Grant amount to give']
+
+def normalize_key(series):
+    """ Lowercase and strip a column of strings so it can be used as a join key, anything that isn't a string becomes NaN """
+    return series.str.lower().str.strip()
+
+def latest_rows_by_key(df, key, columns, prefix):
+    """ Keep the last row for each key (same as taking tail(1) of every match) with only the wanted columns, prefixed """
+    df_latest = pd.DataFrame({'_key': key}).join(df.reindex(columns=columns))
+    df_latest = df_latest.dropna(subset=['_key']).drop_duplicates(subset='_key', keep='last')
+    df_latest = df_latest.rename(columns={column: f'{prefix}{column}' for column in columns})
+    df_latest[f'{prefix}found'] = True
+    return df_latest
+
+def read_user_and_grant_data(path_to_grant_data):
+    """ Only the columns the join and extract_user_data use, processed_data comes from its cached copy while it hasn't changed """
+    with instrumentation.stage('read_users'):
+        df_user_data = raw_store.read_table(raw_store.USERS, ['student_name_1'] + USER_DATA_COLUMNS)
+    with instrumentation.stage('read_grants'):
+        df_grant_data = input_cache.read_excel(path_to_grant_data, ['Email'] + GRANT_DATA_COLUMNS)
+    return (df_user_data, df_grant_data)
+
+def latest_user_and_grant_rows(df_user_data, df_grant_data):
+    """ The latest user_data row for each student_name_1 and processed_data row for each email, what join_enrollment_data joins on """
+    df_users = latest_rows_by_key(df_user_data, normalize_key(df_user_data['student_name_1']), USER_DATA_COLUMNS, 'user_')
+    df_grants = latest_rows_by_key(df_grant_data, normalize_key(df_grant_data['Email']), GRANT_DATA_COLUMNS, 'grant_')
+    return (df_users, df_grants)
+
+def join_enrollment_data(df_enrollment, df_users, df_grants):
+    """
+    Normalize the keys once and join every enrollment to its latest user_data row (matched on student_name_1)
+    and its latest processed_data row (matched on the email inside student_name_1) in one pass, df_users and df_grants come from latest_user_and_grant_rows.
+    Returns one record per enrollment, enrollments without a usable student_name_1 are reported and skipped.
+    """
+    df_joined = df_enrollment.reset_index(drop=True)
+    df_joined['_user_key'] = normalize_key(df_joined['student_name_1'])
+
+    invalid = df_joined['_user_key'].isna()
+    for _, row in df_enrollment[invalid.values].iterrows():
+        print("ERROR: Couldn't process row:")
+        print(row)
+        print("student_name_1 is not text")
+        print("SKIPPING...")
+        instrumentation.count('rows_skipped')
+    df_joined = df_joined[~invalid]
+
+    # A batch where no name has an email (e.g. one --stream page) gives a column of only NaN, which has no .str
+    df_joined['user_email'] = normalize_key(df_joined['student_name_1'].str.split(' ').str[2].astype('string'))
+
+    df_joined = (df_joined
+        .merge(df_users, how='left', left_on='_user_key', right_on='_key')
+        .drop(columns=['_key'])
+        .merge(df_grants, how='left', left_on='user_email', right_on='_key')
+        .drop(columns=['_key', '_user_key']))
+    df_joined['user_found'] = df_joined['user_found'].eq(True)
+    df_joined['grant_found'] = df_joined['grant_found'].eq(True)
+
+    # NaN means the value is missing, use None so nothing gets written to the cell
+    return df_joined.astype(object).where(df_joined.notna(), None).to_dict('records')
+
+def extract_user_data(record):
+    """ This puts combines the data from the various sheets into the format we want, record comes from join_enrollment_data """
     try:
-        email = row['student_name_1'].split(' ')[2]
+        email = record['student_name_1'].split(' ')[2]
     except IndexError:
         email = None
 
     data = {
-        'Full Name': row['student_name_0'],
+        'Full Name': record['student_name_0'],
         'Email Address': email,
     }
 
-    if not user_data_row.empty:
+    if record['user_found']:
         extra = {
-            'Organization': user_data_row['custom_fields_organization'].values[0],
-            'Title': user_data_row['custom_fields_title'].values[0],
-            'Phone Number': user_data_row['custom_fields_phone-number'].values[0],
-            'Mailing Address': user_data_row['custom_fields_mailing-address'].values[0],
-            'Self-Identify as Indigenous?': 'Yes' if user_data_row['custom_fields_indigenous-self-declaration'].astype(str).values[0].lower().strip() == '1' else 'No',
+            'Organization': record['user_custom_fields_organization'],
+            'Title': record['user_custom_fields_title'],
+            'Phone Number': record['user_custom_fields_phone-number'],
+            'Mailing Address': record['user_custom_fields_mailing-address'],
+            'Self-Identify as Indigenous?': 'Yes' if str(record['user_custom_fields_indigenous-self-declaration']).lower().strip() == '1' else 'No',
         }
         data.update(extra)
 
-    if not user_grant_row.empty:
+    if record['grant_found']:
         extra = {
             'Received FSG?': 'Yes',
-            'Grant Amount Received': user_grant_row['Grant amount to give'].values[0]
+            'Grant Amount Received': record['grant_Grant amount to give']
         }
         data.update(extra)
 
     return data
 
-def find_sheet(row):
-    """ This finds the correct sheet based on the user's program, assumes the correct sheet and excel exists """
+def enrollment_entries(df_enrollment, df_users, df_grants):
+    """ The (row, data, user_email) entry for every enrollment that can be distributed """
+    return [(record, extract_user_data(record), record['user_email']) for record in join_enrollment_data(df_enrollment, df_users, df_grants)]
+
+def find_sheet_location(row):
+    """ This finds the excel and sheet session based on the user's program, without opening the excel """
     course_code = row['account_name'].split(" ")[0]
     course_info = row['product_name_0'].split(" ")
     course_session = " ".join(course_info[-2:])
 
     excel_path = REGISTRATIONS_FOLDER_PATH + EXCELS[course_code]
-    workbook = load_workbook(filename=excel_path)
-    return (workbook[course_session], excel_path, workbook)
-
-def search_email_in_sheet(sheet, email):
-    """ Return the row index where email is found, -1 if not found """
-    email_column = None
-
-    for cell in sheet[HEADER_ROW]:
-        if cell.value == 'Email Address':
-            email_column = cell.column_letter
-            break
-
-    if email_column is None:
-        return -1
-
-    for row_idx, cell in enumerate(sheet[email_column], start=1):
-        if cell.value and cell.value.lower().strip() == email:
-            return row_idx
-
-    return -1
-
-def search_name_in_sheet(sheet, name):
-    """ Return the row index where email is found, -1 if not found """
-    name_column = None
-
-    for cell in sheet[HEADER_ROW]:
-        if cell.value == 'Full Name':
-            name_column = cell.column_letter
-            break
-    
-    if name_column is None:
-        return -1
-    
-    for row_idx, cell  in enumerate(sheet[name_column], start=1):
-        if cell.value and cell.value.lower().strip() == name.lower().strip():
-            return row_idx
-        
-    return -1
-
-def find_empty_row(sheet):
-    """ Starting from row 3 of the sheet, find a row where the first column is empty"""
-    for row_index, row in enumerate(sheet.iter_rows(min_row=3), start=3):
-        if row[0].value is None:
-            return row_index
-    return sheet.max_row + 1
+    return (excel_path, course_session)
+
+def group_enrollments_by_sheet(enrollments):
+    """
+    Group the (row, data, user_email) entries by excel and then by sheet session so every excel only has to be opened once.
+    Entries whose sheet can't be worked out are reported and skipped.
+    """
+    groups = {}
+    for entry in enrollments:
+        row, _, user_email = entry
+        try:
+            (excel_path, course_session) = find_sheet_location(row)
+        except Exception as e:
+            print(f"COUlDN'T FIND SHEET FOR {user_email} SKIPPING. Error message {e}")
+            instrumentation.count('rows_skipped')
+            continue
 
-def insert_or_append_row(sheet, data, existing_row):
+        groups.setdefault(excel_path, {}).setdefault(course_session, []).append(entry)
+    return groups
+
+def data_hash(data):
+    """
+    Hash of an entry's data without where it was written, so it's the same before and after writing. The values go through normalize_value
+    and empty ones are left out, the merge makes a column float as soon as one enrollment has no grant so 1000 and 1000.0 must hash the same.
+    """
+    return raw_store.row_hash({column: raw_store.normalize_value(value) for column, value in data.items() if column != 'Excel Path' and not pd.isna(value)})
+
+def ledger_frame(enrollments):
+    """
+    The distribution ledger key (raw_store.LEDGER_KEY) and data hash of every (row, data, user_email) entry, worked out for all of them at once.
+    The program and session are read from the listing the same way find_sheet_location does, entries without an email use their name like search_name.
+    """
+    columns = raw_store.LEDGER_KEY + ['data_hash']
+    if len(enrollments) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df_rows = pd.DataFrame([row for row, _, _ in enrollments], columns=['student_name_0', 'account_name', 'product_name_0', 'product_name_1']).astype('string')
+    user_emails = pd.Series([user_email for _, _, user_email in enrollments], dtype='string')
+    df_ledger = pd.DataFrame({
+        'user_key': user_emails.fillna(normalize_key(df_rows['student_name_0'])),
+        'program': df_rows['account_name'].str.split(' ').str[0],
+        'session': df_rows['product_name_0'].str.split(' ').str[-2:].str.join(' '),
+        'listing_id': df_rows['product_name_1'],
+        'data_hash': [data_hash(data) for _, data, _ in enrollments],
+    })
+    return df_ledger.fillna('').astype(object)
+
+def not_yet_distributed(enrollments, df_distributed):
+    """
+    The entries that aren't in the distribution ledger (df_distributed, from raw_store.read_ledger) with the same data, found with one
+    anti-join so the excels only already distributed enrollments go to are never opened. An entry whose user or grant data changed since
+    it was distributed is kept, writing it again only fills the cells that are still empty.
+    """
+    if len(enrollments) == 0:
+        return enrollments
+    df_merged = ledger_frame(enrollments).merge(df_distributed, how='left', on=raw_store.LEDGER_KEY + ['data_hash'], indicator=True)
+    distributed = df_merged['_merge'].eq('both').tolist()
+
+    instrumentation.count('rows_already_distributed', sum(distributed))
+    if any(distributed):
+        print(f"SKIPPING {sum(distributed)} ENROLLMENTS THAT WERE ALREADY DISTRIBUTED")
+    return [entry for entry, done in zip(enrollments, distributed) if not done]
+
+class SheetIndex:
+    """
+    Lookups for one sheet that would otherwise need a full scan every time: the header -> column map,
+    normalized email -> row and name -> row, and the next empty row. Built once when the sheet is first
+    touched and kept up to date by record_write as rows are written.
+    """
+    # First row that can hold data, the rows above it are the title and the header
+    FIRST_DATA_ROW = 3
+
+    def __init__(self, rows):
+        """ rows is every row of the sheet as a tuple of cell values, starting from row 1 """
+        rows = list(rows)
+        self.columns = {}
+        if len(rows) >= HEADER_ROW:
+            for col_index, value in enumerate(rows[HEADER_ROW - 1], start=1):
+                self.columns.setdefault(value, col_index)
+
+        self.email_rows = {}
+        self.name_rows = {}
+        self.filled_rows = set()
+        self.next_empty_row = self.FIRST_DATA_ROW
+        for row_idx, values in enumerate(rows, start=1):
+            for col_index, value in enumerate(values, start=1):
+                self.record_write(row_idx, col_index, value)
+
+    @classmethod
+    def from_worksheet(cls, sheet):
+        return cls(sheet.iter_rows(values_only=True))
+
+    def _advance_empty_row(self):
+        while self.next_empty_row in self.filled_rows:
+            self.next_empty_row += 1
+
+    def _add_lookup(self, lookup, value, row_idx):
+        """ Keep the first row a value shows up in, same as scanning the column from the top """
+        if value and isinstance(value, str):
+            key = value.lower().strip()
+            if key not in lookup or row_idx < lookup[key]:
+                lookup[key] = row_idx
+
+    def record_write(self, row_idx, col_index, value):
+        """ Update the lookups after value was written to the cell """
+        if value is None:
+            return
+
+        if col_index == 1 and row_idx >= self.FIRST_DATA_ROW:
+            self.filled_rows.add(row_idx)
+            if row_idx == self.next_empty_row:
+                self._advance_empty_row()
+        if col_index == self.columns.get('Email Address'):
+            self._add_lookup(self.email_rows, value, row_idx)
+        if col_index == self.columns.get('Full Name'):
+            self._add_lookup(self.name_rows, value, row_idx)
+
+    def search_email(self, email):
+        """ Return the row index where email is found, -1 if not found """
+        return self.email_rows.get(email, -1)
+
+    def search_name(self, name):
+        """ Return the row index where name is found, -1 if not found """
+        return self.name_rows.get(name.lower().strip(), -1)
+
+    def find_empty_row(self):
+        """ Starting from row 3 of the sheet, the first row where the first column is empty """
+        return self.next_empty_row
+
+def insert_or_append_row(sheet, index, data, existing_row):
 
     # check if a table exists in the sheet (will use the first table listed if more than one)
     table = sheet.tables[list(sheet.tables.keys())[0]] if len(sheet.tables) > 0 else None
@@ -154,19 +315,16 @@ def insert_or_append_row(sheet, data, existing_row):
     """ If the row exists (not -1) then add data to columns that are empty, else append to end of sheet """
     row = existing_row if existing_row != -1 else None
     if row is None:
-        row = find_empty_row(sheet)
+        row = index.find_empty_row()
         
     for col_header, value in data.items():
-        col_index = None
-        for cell in sheet[HEADER_ROW]: # Find the column where the current header is
-            if cell.value == col_header:
-                col_index = cell.column
-                break
+        col_index = index.columns.get(col_header) # Find the column where the current header is
 
         if col_index is not None:
             target_cell = sheet.cell(row=row, column=col_index)
             if target_cell.value is None:
                 target_cell.value = value
+                index.record_write(row, col_index, value)
     
     # if a table exists and the current row was appended, update table range (ref)
     if(existing_row == -1 and table is not None):
@@ -177,58 +335,241 @@ def insert_or_append_row(sheet, data, existing_row):
         # update table ref to include new data in table
         table.ref = f"{table_start}:{table_end_col}{row}"
             
-def distribute_enrollment_data(df_enrollment, path_to_user_data, path_to_grant_data):
-    """ Loops through all the enrollment users, and distributes their data to the correct sheet """
-    df_user_data = pd.read_excel(path_to_user_data)
-    df_grant_data = pd.read_excel(path_to_grant_data)
-    all_rows = []
-
-    for _, row in df_enrollment.iterrows():
-        # Search for the row in user_data based on student_name_1 and email inside student_name_1
+def write_entries(sheet, index, excel_path, entries, log):
+    """ Write the (row, data, user_email) entries into the sheet, returns the entries that were written. Errors are handled per row """
+    written_entries = []
+    for row, data, user_email in entries:
         try:
-            user_data_row = df_user_data[df_user_data['student_name_1'].str.lower().str.strip() == row['student_name_1'].lower().strip()].tail(1)
-        except:
-            print("ERROR: Couldn't process row:")
-            print(row)
-            print(traceback.format_exc())
-            print("SKIPPING...")
+            # 3: Check if email already in sheet, if not, search by name
+            if user_email is not None:
+                existing_row = index.search_email(user_email)
+            else:
+                user_full_name = row['student_name_0']
+                existing_row = index.search_name(user_full_name)
+
+            # 4: Insert data at the end or write to the existing row
+            insert_or_append_row(sheet, index, data, existing_row)
+        except Exception:
+            log.append("ERROR: Couldn't write row:")
+            log.append(str(row))
+            log.append(traceback.format_exc())
+            log.append("SKIPPING...")
+            instrumentation.count('rows_skipped')
             continue
-        try:
-            user_email = row['student_name_1'].split(' ')[2].lower().strip()
-        except IndexError:
-            user_email = None
 
-        user_grant_row = df_grant_data[df_grant_data['Email'].str.lower().str.strip() == user_email].tail(1)
-        data = extract_user_data(row, user_data_row, user_grant_row)
-        # 2: find the correct sheet to use
+        data["Excel Path"] = excel_path.split("/")[-1]
+        written_entries.append((row, data, user_email))
+        instrumentation.count('rows_written')
+        log.append(f"APPENDED DATA TO {data['Excel Path']} FOR {user_email if user_email is not None else row['student_name_0']}")
+    return written_entries
+
+def session_values(sessions):
+    return [value for entries in sessions.values() for _, data, _ in entries for value in data.values()]
+
+def open_workbook(excel_path, sessions, log):
+    """
+    Open the excel with xlsx_fast, which only reads and rewrites the sheets that are written to, or with openpyxl if the fast path
+    can't write these values or this excel. Any other error opening the excel (e.g. it's missing or not an xlsx) is raised.
+    """
+    if xlsx_fast.values_supported(session_values(sessions)):
         try:
-            (sheet, excel_path, workbook) = find_sheet(row)
-        except Exception as e:
-            print(f"COUlDN'T FIND SHEET FOR {user_email} SKIPPING. Error message {e}")
+            workbook = xlsx_fast.FastWorkbook(excel_path, sessions.keys())
+            instrumentation.count('workbooks_fast')
+            return workbook
+        except xlsx_fast.Unsupported as e:
+            log.append(f"USING OPENPYXL FOR {excel_path}. Fast path message {e}")
+
+    # openpyxl is only loaded by the processes that need it
+    from openpyxl import load_workbook
+    return load_workbook(filename=excel_path)
+
+def distribute_to_workbook(excel_path, sessions):
+    """
+    Open the excel once, write every enrollment for each of its sheet sessions, then save it once.
+    Errors are handled per row so one bad row doesn't drop the rest of the excel.
+    Returns the entries that were written and the console messages, so this can run in a worker process.
+    """
+    all_entries = []
+    log = []
+    try:
+        with instrumentation.stage('load_workbook'):
+            workbook = open_workbook(excel_path, sessions, log)
+    except Exception as e:
+        for _, _, user_email in (entry for entries in sessions.values() for entry in entries):
+            log.append(f"COUlDN'T FIND SHEET FOR {user_email} SKIPPING. Error message {e}")
+            instrumentation.count('rows_skipped')
+        return (all_entries, log)
+    instrumentation.count('workbooks_loaded')
+
+    for course_session, entries in sessions.items():
+        try:
+            sheet = workbook[course_session]
+        except KeyError as e:
+            for _, _, user_email in entries:
+                log.append(f"COUlDN'T FIND SHEET FOR {user_email} SKIPPING. Error message {e}")
+                instrumentation.count('rows_skipped')
             continue
 
-        # 3: Check if email already in sheet, if not, search by name
-        if user_email is not None:
-            existing_row = search_email_in_sheet(sheet, user_email)
-        else:
-            user_full_name = row['student_name_0']
-            existing_row = search_name_in_sheet(sheet, user_full_name)
+        with instrumentation.stage('index_sheet'):
+            index = SheetIndex.from_worksheet(sheet)
+        with instrumentation.stage('write_rows'):
+            all_entries.extend(write_entries(sheet, index, excel_path, entries, log))
 
-        # 4: Insert data at the end or write to the existing row
-        insert_or_append_row(sheet, data, existing_row)
-        data["Excel Path"] = excel_path.split("/")[-1]
-        all_rows.append(data)
-        print(f"APPENDED DATA TO {data['Excel Path']} FOR {user_email if user_email is not None else user_full_name}")
+    with instrumentation.stage('save_workbook'):
         workbook.save(excel_path)
+    instrumentation.count('workbooks_saved')
+    return (all_entries, log)
+
+def distribute_to_workbook_in_worker(excel_path, sessions):
+    """ distribute_to_workbook for a worker process, also returns the worker's timings and counters so they can be merged into the run report """
+    instrumentation.reset()
+    (all_entries, log) = distribute_to_workbook(excel_path, sessions)
+    return (all_entries, log, instrumentation.report())
+
+def distribute_enrollment_data(df_enrollment, path_to_grant_data, workers=1, redistribute=False, run_id=None):
+    """
+    Loops through all the enrollment users, and distributes their data to the correct sheet.
+    Enrollments the distribution ledger already has are skipped unless redistribute is set.
+    With workers > 1 each excel is loaded, updated and saved in its own process.
+    Each excel's rows go in the ledger as soon as it's saved, so a run that fails part way only writes the excels it didn't get to when it's run again.
+    """
+    run_id = run_id or new_run_id()
+    (df_user_data, df_grant_data) = read_user_and_grant_data(path_to_grant_data)
+    (df_users, df_grants) = latest_user_and_grant_rows(df_user_data, df_grant_data)
+    enrollments = enrollment_entries(df_enrollment, df_users, df_grants)
+    if not redistribute:
+        with instrumentation.stage('check_ledger'):
+            enrollments = not_yet_distributed(enrollments, raw_store.read_ledger())
+
+    # 2: find the correct sheet to use, each excel is loaded and saved once for all of its rows
+    groups = group_enrollments_by_sheet(enrollments)
+    distributed_count = 0
+
+    if workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+            results = executor.map(distribute_to_workbook_in_worker, groups.keys(), groups.values())
+            for (entries, log, worker_report) in results:
+                instrumentation.merge(worker_report)
+                for line in log:
+                    print(line)
+                save_history(entries, run_id)
+                distributed_count += len(entries)
+    else:
+        for excel_path, sessions in groups.items():
+            (entries, log) = distribute_to_workbook(excel_path, sessions)
+            for line in log:
+                print(line)
+            save_history(entries, run_id)
+            distributed_count += len(entries)
     
-    df = pd.DataFrame(all_rows)
-    save_path = add_date_to_filename(os.environ.get('ENROLLMENTS_HISTORY_PATH'))
-    df.to_excel(save_path, index=False)
-    print("SAVED ENROLLMENTS THAT WILL BE DISTRIBUTED TO", save_path)    
+    print_history_saved(distributed_count, run_id)
+
+def new_run_id():
+    return datetime.now().strftime('%Y%m%d_%H%M%S')
+
+def save_history(entries, run_id):
+    """ Record the distributed entries in the ledger so later runs skip them, their rows are added to the run's distribution history """
+    if len(entries) == 0:
+        return
+    df_ledger = ledger_frame(entries)
+    df_ledger['excel'] = [data["Excel Path"] for _, data, _ in entries]
+    raw_store.save_distribution(run_id, df_ledger, [data for _, data, _ in entries])
+
+def print_history_saved(distributed_count, run_id):
+    print(f"SAVED {distributed_count} DISTRIBUTED ENROLLMENTS AS RUN {run_id} OF THE DISTRIBUTION HISTORY")
 
     print("DONE DISTRIBUTING DATA")
 
+class Distributor:
+    """
+    Distributes enrollments a batch at a time, for get_data's streaming pipeline. Every excel stays open with its sheet indexes
+    after its first batch so later batches don't reload it, finish saves each excel once and writes its rows to the history.
+    The users and grants are read once, so the users have to be in the raw data store before the first batch.
+    """
+    def __init__(self, path_to_grant_data, run_id=None):
+        self.run_id = run_id or new_run_id()
+        (df_user_data, df_grant_data) = read_user_and_grant_data(path_to_grant_data)
+        (self.df_users, self.df_grants) = latest_user_and_grant_rows(df_user_data, df_grant_data)
+        self.df_distributed = raw_store.read_ledger()
+
+        # excel path -> workbook, or the error if it couldn't be loaded
+        self.workbooks = {}
+        # (excel path, sheet session) -> SheetIndex
+        self.indexes = {}
+        # excel path -> the entries written to it
+        self.entries = {}
+
+    def load(self, excel_path, sessions, log):
+        if excel_path not in self.workbooks:
+            try:
+                with instrumentation.stage('load_workbook'):
+                    self.workbooks[excel_path] = open_workbook(excel_path, sessions, log)
+                instrumentation.count('workbooks_loaded')
+            except Exception as e:
+                self.workbooks[excel_path] = e
+
+        workbook = self.workbooks[excel_path]
+        if isinstance(workbook, xlsx_fast.FastWorkbook):
+            try:
+                if not xlsx_fast.values_supported(session_values(sessions)):
+                    raise xlsx_fast.Unsupported("Can't write every value of the batch")
+                for course_session in sessions:
+                    if course_session in workbook.sheetnames:
+                        workbook[course_session]
+            except xlsx_fast.Unsupported as e:
+                # Keep what's written so far and carry on with openpyxl for this excel
+                log.append(f"USING OPENPYXL FOR {excel_path}. Fast path message {e}")
+                workbook.save(excel_path)
+                self.indexes = {key: index for key, index in self.indexes.items() if key[0] != excel_path}
+                from openpyxl import load_workbook
+                with instrumentation.stage('load_workbook'):
+                    workbook = self.workbooks[excel_path] = load_workbook(filename=excel_path)
+        return workbook
+
+    def add(self, df_enrollment):
+        """ Write a batch of enrollments into the open excels """
+        with instrumentation.stage('check_ledger'):
+            enrollments = not_yet_distributed(enrollment_entries(df_enrollment, self.df_users, self.df_grants), self.df_distributed)
+        groups = group_enrollments_by_sheet(enrollments)
+        log = []
+        for excel_path, sessions in groups.items():
+            workbook = self.load(excel_path, sessions, log)
+            for course_session, entries in sessions.items():
+                try:
+                    if isinstance(workbook, Exception):
+                        raise workbook
+                    sheet = workbook[course_session]
+                except Exception as e:
+                    for _, _, user_email in entries:
+                        log.append(f"COUlDN'T FIND SHEET FOR {user_email} SKIPPING. Error message {e}")
+                        instrumentation.count('rows_skipped')
+                    continue
+
+                if (excel_path, course_session) not in self.indexes:
+                    with instrumentation.stage('index_sheet'):
+                        self.indexes[(excel_path, course_session)] = SheetIndex.from_worksheet(sheet)
+                with instrumentation.stage('write_rows'):
+                    self.entries.setdefault(excel_path, []).extend(write_entries(sheet, self.indexes[(excel_path, course_session)], excel_path, entries, log))
+
+        for line in log:
+            print(line)
+
+    def finish(self):
+        """ Save every excel that was written to, each one's rows go in the ledger and history once it's saved """
+        for excel_path, workbook in self.workbooks.items():
+            if not isinstance(workbook, Exception):
+                with instrumentation.stage('save_workbook'):
+                    workbook.save(excel_path)
+                instrumentation.count('workbooks_saved')
+                save_history(self.entries.get(excel_path, []), self.run_id)
+        print_history_saved(sum(len(entries) for entries in self.entries.values()), self.run_id)
+
 if __name__ == '__main__':
     # This is mainly for testing, call python get_data.py instead
-    df = pd.read_excel(os.environ.get("RAW_DATA_PATH_ENROLLMENTS"))
-    distribute_enrollment_data(df, os.environ.get("RAW_DATA_PATH_USERS"), os.environ.get("PROCESSED_DATA_PATH"))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Distribute the raw enrollments to the registration excels')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to update the registration excels in parallel, one excel per process. Defaults to 1')
+    parser.add_argument('--redistribute', action='store_true', help='Write every enrollment again, including the ones the distribution ledger says were already distributed (e.g. after rows were deleted from an excel)')
+    args = parser.parse_args()
+
+    df = raw_store.read_table(raw_store.ENROLLMENTS)
+    distribute_enrollment_data(df, os.environ.get("PROCESSED_DATA_PATH"), args.workers, args.redistribute)
\ No newline at end of file
@@ -1,44 +1,147 @@
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException
-import re
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-import pandas as pd
 import argparse
 import os
+import json
+import atexit
+import cProfile
+import pstats
+import queue
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
-import distribute
+import instrumentation
+import snapshots
 
 load_dotenv()
 
-# get selected browser from environment variables, default to Chrome
-browser = os.environ.get("BROWSER")
+# Browser profile folder that keeps the login between runs, a new temporary profile is used every run if it isn't set
+BROWSER_PROFILE_DIR = os.environ.get("BROWSER_PROFILE_DIR")
 
-if browser == "Edge":
-    from webdriver_manager.microsoft import EdgeChromiumDriverManager
-    from selenium.webdriver.edge.service import Service as EdgeService
+# Where the driver manager found each browser's driver, so most runs start the browser without the driver manager or the network
+DRIVER_CACHE_PATH = os.environ.get("DRIVER_CACHE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "driver_cache.json")
+DRIVER_CACHE_DAYS = 7
 
-    driver = webdriver.Edge(service=EdgeService(EdgeChromiumDriverManager().install()))
-elif browser == "Firefox":
-    from webdriver_manager.firefox import GeckoDriverManager
-    from selenium.webdriver.firefox.service import Service as FirefoxService
+def chromium_options(options, headless, profile_dir):
+    """ Options shared by Chrome, Chromium and Edge """
+    if headless:
+        options.add_argument("--headless=new")
+        options.add_argument(f"--window-size={HEADLESS_WINDOW_SIZE}")
+    if profile_dir:
+        options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
+    return options
 
-    driver = webdriver.Firefox(service=FirefoxService(GeckoDriverManager().install()))
-elif browser == "Chromium":
-    from webdriver_manager.core.utils import ChromeType
-    from selenium.webdriver.chrome.service import Service as ChromiumService
-    
-    driver = webdriver.Chrome(service=ChromiumService(ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()))
-else:
-    from webdriver_manager.chrome import ChromeDriverManager
-    from selenium.webdriver.chrome.service import Service as ChromeService
+def cached_driver_path(browser, install, refresh=False):
+    """
+    Path of the browser's driver, from the cache if it was found in the last DRIVER_CACHE_DAYS days, otherwise from install (the driver manager).
+    If the driver manager fails, e.g. there's no network, the cached driver is used even if it's older.
+    """
+    cache = {}
+    if os.path.isfile(DRIVER_CACHE_PATH):
+        with open(DRIVER_CACHE_PATH) as f:
+            cache = json.load(f)
+
+    cached = cache.get(browser)
+    if cached is not None and not os.path.isfile(cached['path']):
+        cached = None
+    if cached is not None and not refresh and datetime.now() - datetime.fromisoformat(cached['found_at']) < timedelta(days=DRIVER_CACHE_DAYS):
+        return cached['path']
+
+    try:
+        path = install()
+    except Exception as e:
+        if cached is None:
+            raise
+        print(f"COULDN'T UPDATE THE {browser} DRIVER, USING THE CACHED ONE. Error message {e}")
+        return cached['path']
+
+    cache[browser] = {'path': path, 'found_at': datetime.now().isoformat(timespec='seconds')}
+    with open(DRIVER_CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=2)
+    return path
+
+def create_driver(headless=False, use_profile=True):
+    """
+    Start the browser selected in the environment variables, defaults to Chrome.
+    This is only called when the script runs so importing get_data (e.g. in the distribute worker processes) doesn't open a browser.
+    If BROWSER_PROFILE_DIR is set the browser keeps its cookies there between runs, so the login is only needed when the session expires.
+    A profile can only be open in one browser at a time, so the shard browsers are started with use_profile=False.
+    """
+    browser = os.environ.get("BROWSER") or "Chrome"
+    profile_dir = BROWSER_PROFILE_DIR if use_profile else None
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    # The driver manager is only imported when the cached driver is missing or too old
+    if browser == "Edge":
+        from selenium.webdriver.edge.service import Service as EdgeService
+
+        def install():
+            from webdriver_manager.microsoft import EdgeChromiumDriverManager
+            return EdgeChromiumDriverManager().install()
+
+        options = chromium_options(webdriver.EdgeOptions(), headless, profile_dir)
+        start = lambda path: webdriver.Edge(service=EdgeService(path), options=options)
+    elif browser == "Firefox":
+        from selenium.webdriver.firefox.service import Service as FirefoxService
+
+        def install():
+            from webdriver_manager.firefox import GeckoDriverManager
+            return GeckoDriverManager().install()
+
+        options = webdriver.FirefoxOptions()
+        if headless:
+            options.add_argument("-headless")
+            width, height = HEADLESS_WINDOW_SIZE.split(",")
+            options.add_argument(f"--width={width}")
+            options.add_argument(f"--height={height}")
+        if profile_dir:
+            options.add_argument("-profile")
+            options.add_argument(os.path.abspath(profile_dir))
+        start = lambda path: webdriver.Firefox(service=FirefoxService(path), options=options)
+    elif browser == "Chromium":
+        from selenium.webdriver.chrome.service import Service as ChromiumService
+
+        def install():
+            from webdriver_manager.chrome import ChromeDriverManager
+            from webdriver_manager.core.utils import ChromeType
+            return ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
+
+        options = chromium_options(webdriver.ChromeOptions(), headless, profile_dir)
+        start = lambda path: webdriver.Chrome(service=ChromiumService(path), options=options)
+    else:
+        from selenium.webdriver.chrome.service import Service as ChromeService
+
+        def install():
+            from webdriver_manager.chrome import ChromeDriverManager
+            return ChromeDriverManager().install()
 
-    driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()))
+        options = chromium_options(webdriver.ChromeOptions(), headless, profile_dir)
+        start = lambda path: webdriver.Chrome(service=ChromeService(path), options=options)
+
+    try:
+        return start(cached_driver_path(browser, install))
+    except SessionNotCreatedException:
+        # Usually the browser updated itself and the cached driver is too old for it
+        print(f"THE CACHED {browser} DRIVER DIDN'T START, GETTING A NEW ONE")
+        return start(cached_driver_path(browser, install, refresh=True))
+
+def copy_cookies(cookies, driver):
+    """ Log driver in with the cookies of another browser, a cookie can only be added while the browser is on the cookie's domain """
+    cookies_by_domain = {}
+    for cookie in cookies:
+        cookies_by_domain.setdefault(cookie.get('domain', '').lstrip('.'), []).append(cookie)
+
+    for domain, domain_cookies in cookies_by_domain.items():
+        driver.get(f"https://{domain}/")
+        for cookie in domain_cookies:
+            try:
+                driver.add_cookie(cookie)
+            except WebDriverException as e:
+                print(f"COULDN'T COPY COOKIE {cookie['name']} FOR {domain}. Error message {e.msg}")
 
 # NOTE: KEEP THIS VALID_COURSES AND FULL_OPTION_NAME UP TO DATE
 VALID_COURSES = [
@@ -82,101 +185,234 @@ FULL_OPTION_NAME = {
 
 ENROLLMENT_STATUSES = ['Active', 'Completed', 'Concluded', 'Dropped']
 
+ENROLLMENTS_URL = "https://courses.cpe.ubc.ca/new_analytics/enrollments"
+USERS_URL = "https://courses.cpe.ubc.ca/new_analytics/users"
+
+# The users page search box, --lookup-users searches it for one email at a time
+USER_SEARCH_INPUT_SELECTOR = 'input[type="search"]'
+# Above this many users to look up it's faster to page through the whole users table
+MAX_USER_LOOKUPS = 50
+# Stored users that weren't stored or looked up for this many days are looked up again in case their profile changed
+STALE_USER_DAYS = 30
+
+# How many scraped pages can wait for the distribution thread with --stream before scraping pauses, keeps memory flat if distributing is slower
+STREAM_QUEUE_SIZE = 4
+
+# Window size of the headless browsers, big enough that the filters and pagination render like they do on screen
+HEADLESS_WINDOW_SIZE = "1920,1080"
+
+# With --serve, how often (seconds) the users tab is reloaded while waiting for the next run so the session doesn't time out
+KEEP_ALIVE_SECONDS = 300
+
 def print_decorator(func):
-    # This just prints the function name before and after, useful for debugging
+    # This prints the function name before and after, useful for debugging, and times it as a stage of the run report
     def wrapper(*args, **kwargs):
         print(f"{'-'*15}STARTING {func.__name__}{'-'*15}")
-        result = func(*args, **kwargs)
+        with instrumentation.stage(func.__name__):
+            result = func(*args, **kwargs)
         print(f"{'+'*15}FINISHED {func.__name__}{'+'*15}")
         return result
     return wrapper
 
-def append_data_to_excel(filename, df_new_data):
-    """ Take in an excel and combine the data, then remove duplicates prioriziting keeping the existing data """
-    if os.path.isfile(filename):
-        try:
-            df_old = pd.read_excel(filename)
-        except Exception as e:
-            print(f"Error reading the Excel file: {e}")
-            df_combined = df_new_data
-        else:
-            df_combined = (pd.concat([df_old, df_new_data], ignore_index=True, sort=False)
-                .drop_duplicates(keep='first'))
-
-    else:
-        df_combined = df_new_data
-
-    df_combined.to_excel(filename, index=False)
+def append_data_to_store(table, df_new_data):
+    """ Add the scraped rows to the raw data store, only rows that aren't already stored get appended """
+    with instrumentation.stage('store_rows'):
+        new_rows = raw_store.append_rows(table, df_new_data)
+    instrumentation.count(f'{table}_rows_scraped', len(df_new_data))
+    instrumentation.count(f'{table}_rows_new', new_rows)
+    print(f"ADDED {new_rows} NEW ROWS TO {table} ({len(df_new_data) - new_rows} ALREADY STORED)")
     return df_new_data
 
+LOGIN_LINK_XPATH = '//a[@href="http://ubccpe.instructure.com/login/saml"]'
+SHOW_FILTERS_BUTTON_XPATH = "//button[@data-automation='Filter__Show__Filters__Button']"
+APPLY_FILTERS_BUTTON_SELECTOR = 'button[form="filter-panel-form"]'
+CURRENT_PAGE_BUTTON_SELECTOR = "[data-automation='Pagination'] button[aria-current='page']"
+
+class LoginFailed(Exception):
+    """ The login timed out, or a headless browser's session expired """
 
 @print_decorator
-def login():
-    """ Open the url which will prompt a login """
-    driver.get("https://courses.cpe.ubc.ca/new_analytics/enrollments")
+def login(driver, headless=False):
+    """
+    Open the url which will prompt a login, unless the browser profile still has a valid session.
+    A headless browser can't show the login page, so it raises LoginFailed if the session has expired.
+    """
+    driver.get(ENROLLMENTS_URL)
+
+    # The analytics page either asks to login or shows the filters straight away when the session is still valid
+    SECONDS_TO_LOAD = 30
+    page_element = WebDriverWait(driver, SECONDS_TO_LOAD).until(EC.any_of(
+        EC.presence_of_element_located((By.XPATH, LOGIN_LINK_XPATH)),
+        EC.presence_of_element_located((By.XPATH, SHOW_FILTERS_BUTTON_XPATH))
+    ))
+    if page_element.tag_name == 'button':
+        print("ALREADY LOGGED IN")
+        return
+
     # Click the login button
-    link = driver.find_element(By.XPATH, '//a[@href="http://ubccpe.instructure.com/login/saml"]')
-    link.click()
+    page_element.click()
 
     SECONDS_TO_LOGIN = 90
-    wait = WebDriverWait(driver, SECONDS_TO_LOGIN)
-    wait.until(EC.url_contains('enrollments'))
-
-def check_page_source(driver, option):
-    """ This returns true if the enrollment filtering option has shown up on the page """
-    soup = BeautifulSoup(driver.page_source, 'html.parser')
-    
-    # Find all <div> elements with the "title" attribute
-    divs_with_title = soup.find_all('div', {'title': True})
-    
-    # Iterate over the matching <div> elements
-    for div in divs_with_title:
-        text = div.get_text()
-        
-        # Search for the pattern in the text
-        pattern = re.escape(option)
-        found = re.search(pattern, text)
-        
-        if found:
-            print("FOUND:", text)
-            return True
+    try:
+        WebDriverWait(driver, SECONDS_TO_LOGIN).until(EC.url_contains('enrollments'))
+    except TimeoutException:
+        driver.quit()
+        if headless:
+            raise LoginFailed("SESSION EXPIRED. RUN ONCE WITHOUT --headless TO LOGIN AGAIN")
+        raise LoginFailed("LOGIN TIMED OUT")
+
+# How often (seconds) to check if a filter option has rendered, the default of 0.5 adds up over every course and status
+FILTER_POLL_FREQUENCY = 0.1
+
+CATALOG_FILTER_SELECTOR = 'input[data-automation="AnalyticsPage__Filter__Catalog"]'
+STATUS_FILTER_SELECTOR = 'input[data-automation="AnalyticsPage__Filter__Enrollment__Status"]'
+
+def xpath_literal(text):
+    """ Quote text for an XPath expression, XPath has no escape characters so text with both quote types is split up with concat() """
+    if "'" not in text:
+        return f"'{text}'"
+    if '"' not in text:
+        return f'"{text}"'
+    return "concat('" + "', \"'\", '".join(text.split("'")) + "')"
+
+# Runs in the browser (execute_async_script) and selects every option of a filter dropdown in one call, the same way typing it does:
+# set the input's value through React, wait for the option to render, then ArrowDown and Enter.
+# Arguments are the input's CSS selector, [[text to type, option title]...], the wait for each option and the poll interval in ms.
+# Calls back with {option title: 'selected' | 'not found' | 'not selected'}, 'not selected' when the option rendered but its title
+# didn't show up in the filter panel (outside the option list) afterwards.
+SELECT_OPTIONS_SCRIPT = """
+const [selector, options, timeoutMs, pollMs] = arguments;
+const done = arguments[arguments.length - 1];
+const setValue = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+const waitFor = async (check, ms) => {
+    const started = Date.now();
+    while (Date.now() - started < ms) {
+        if (check()) {
+            return true;
+        }
+        await sleep(pollMs);
+    }
+    return false;
+};
+const rendered = (title) => Array.from(document.querySelectorAll('div[title]')).some((div) => div.textContent.includes(title));
+const tagged = (title) => {
+    const panel = document.getElementById('filter-panel-form') || document.body;
+    return Array.from(panel.querySelectorAll('*')).some((element) => element.children.length === 0 &&
+        !element.closest('[role="listbox"], [role="option"], div[title]') && element.textContent.includes(title));
+};
+const press = (input, key, keyCode) => {
+    input.dispatchEvent(new KeyboardEvent('keydown', {key: key, code: key, keyCode: keyCode, which: keyCode, bubbles: true}));
+};
+
+(async () => {
+    const results = {};
+    for (const [typed, title] of options) {
+        const input = document.querySelector(selector);
+        input.focus();
+        setValue.call(input, typed);
+        input.dispatchEvent(new Event('input', {bubbles: true}));
+        if (!(await waitFor(() => rendered(title), timeoutMs))) {
+            results[title] = 'not found';
+            continue;
+        }
+        press(input, 'ArrowDown', 40);
+        await sleep(pollMs);
+        press(input, 'Enter', 13);
+        // The selected tag renders straight after ENTER, so this wait is kept short
+        results[title] = (await waitFor(() => tagged(title), Math.min(timeoutMs, 2000))) ? 'selected' : 'not selected';
+    }
+    done(results);
+})().catch((error) => done({error: String(error)}));
+"""
+
+# How long (seconds) each filter option can take to render, used for the batched selection and the one option at a time fallback
+OPTION_WAIT_SECONDS = 10
+
+def option_rendered(driver, option):
+    """ This returns true if the filtering option has shown up on the page (a <div> with a title attribute containing the option) """
+    instrumentation.count('filter_option_polls')
+    if driver.find_elements(By.XPATH, f"//div[@title and contains(., {xpath_literal(option)})]"):
+        print("FOUND:", option)
+        return True
     
     return False
 
+def select_option(driver, input_selector, typed, title):
+    """ Type into the filter's input, wait for the option with this title and select it with ARROW_DOWN and ENTER, returns False if it didn't show up """
+    dropdown_menu = driver.find_element(By.CSS_SELECTOR, input_selector)
+    dropdown_menu.clear()
+    dropdown_menu.send_keys(typed)
+
+    try:
+        WebDriverWait(driver, OPTION_WAIT_SECONDS, poll_frequency=FILTER_POLL_FREQUENCY).until(lambda driver: option_rendered(driver, title))
+        # Then send the ENTER key
+        option_input = driver.find_element(By.CSS_SELECTOR, input_selector)
+        option_input.send_keys(Keys.ARROW_DOWN)
+        option_input.send_keys(Keys.ENTER)
+        return True
+    except (TimeoutException, KeyboardInterrupt):
+        return False
+
+def select_options(driver, input_selector, options):
+    """
+    Select every (text to type, option title) of a filter dropdown with one script call (SELECT_OPTIONS_SCRIPT) so filtering costs about the same for
+    any number of options, then check the result. If the script fails every option is selected one at a time like before.
+    Returns the titles of the options that never showed up.
+    """
+    statuses = {}
+    previous_timeout = driver.timeouts.script
+    try:
+        driver.set_script_timeout(len(options) * 2 * OPTION_WAIT_SECONDS + 10)
+        with instrumentation.stage('select_options_script'):
+            statuses = driver.execute_async_script(SELECT_OPTIONS_SCRIPT, input_selector, options, OPTION_WAIT_SECONDS * 1000, int(FILTER_POLL_FREQUENCY * 1000))
+        if 'error' in statuses:
+            print("COULDN'T SELECT THE OPTIONS IN ONE GO, SELECTING THEM ONE AT A TIME. Error message", statuses['error'])
+            statuses = {}
+    except WebDriverException as e:
+        print("COULDN'T SELECT THE OPTIONS IN ONE GO, SELECTING THEM ONE AT A TIME. Error message", e.msg)
+    finally:
+        driver.set_script_timeout(previous_timeout)
+
+    not_found = [title for title, status in statuses.items() if status == 'not found']
+    for typed, title in options:
+        status = statuses.get(title)
+        if status == 'selected':
+            print("SELECTED:", title)
+            continue
+        if status == 'not found':
+            continue
+        if status == 'not selected':
+            # ENTER was pressed on the option already, pressing it again would unselect an option that was selected after all
+            print("COULDN'T CONFIRM THE OPTION WAS SELECTED:", title)
+            continue
+
+        instrumentation.count('filter_options_one_at_a_time')
+        if select_option(driver, input_selector, typed, title):
+            print("SELECTED ONE AT A TIME:", title)
+        else:
+            not_found.append(title)
+    return not_found
+
 @print_decorator
-def filtering(courses):
-    """ This clicks the filter button on the enrollments page and searches for all the courses then selects them """
+def filtering(driver, courses):
+    """ This clicks the filter button on the enrollments page and selects all the courses at once """
     wait = WebDriverWait(driver, 10)
-    button = wait.until(EC.visibility_of_element_located((By.XPATH,  "//button[@data-automation='Filter__Show__Filters__Button']")))
+    button = wait.until(EC.visibility_of_element_located((By.XPATH, SHOW_FILTERS_BUTTON_XPATH)))
 
     button.click()
     
     # Wait until the dropdown menu is visible
-    dropdown_menu = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Catalog"]')))
+    dropdown_menu = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, CATALOG_FILTER_SELECTOR)))
     dropdown_menu.click()
-    
-    # Add " - " to courses since that differentiates a program from a course
-    options_to_select = [course + " - " for course in courses]
-
-    # Iterate over the options you want to select
-    for option in options_to_select:
-        # Type the name of the option to filter the dropdown menu
-        dropdown_menu = driver.find_element(By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Catalog"]')
-        dropdown_menu.clear()
-        dropdown_menu.send_keys(option)
 
-        try:
-            wait.until(lambda driver: check_page_source(driver, FULL_OPTION_NAME[option]))
-            # Then send the ENTER key
-            catalog_filter = driver.find_element(By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Catalog"]')
-            catalog_filter.send_keys(Keys.ARROW_DOWN)
-            catalog_filter.send_keys(Keys.ENTER)
-
-        except (TimeoutException, KeyboardInterrupt):
-            print("OPTION NOT FOUND IN TIME", option)
+    # Add " - " to courses since that differentiates a program from a course
+    options_to_select = [(course + " - ", FULL_OPTION_NAME[course + " - "]) for course in courses]
+    for option in select_options(driver, CATALOG_FILTER_SELECTOR, options_to_select):
+        print("OPTION NOT FOUND IN TIME", option)
 
 @print_decorator
-def filter_enrollment_status(status_list):
+def filter_enrollment_status(driver, status_list):
     """ Apply the specified status filters when the ```--status``` argument is used. """
     wait = WebDriverWait(driver, 10)
 
@@ -185,30 +421,19 @@ def filter_enrollment_status(status_list):
     enrollments_accordion_button.click()
 
     #wait until the "Status" dropdown is visible
-    status_dropdown = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Enrollment__Status"]')))
+    status_dropdown = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, STATUS_FILTER_SELECTOR)))
     status_dropdown.click()
 
-    # iterate over status list and select each status for filtering
-    for status in status_list:
-        status_dropdown = driver.find_element(By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Enrollment__Status"]')
-        status_dropdown.clear()
-        status_dropdown.send_keys(status)
-
-        # check if selected status exists in page and select if so
-        try:
-            wait.until(lambda driver: check_page_source(driver, status))
-            status_filter = driver.find_element(By.CSS_SELECTOR, 'input[data-automation="AnalyticsPage__Filter__Enrollment__Status"]')
-            status_filter.send_keys(Keys.ARROW_DOWN)
-            status_filter.send_keys(Keys.ENTER)
-        except (TimeoutException, KeyboardInterrupt):
-            print("COULDN'T FIND STATUS:", status)
+    # select every status at once, they show up with the same text that is typed
+    for status in select_options(driver, STATUS_FILTER_SELECTOR, [(status, status) for status in status_list]):
+        print("COULDN'T FIND STATUS:", status)
 
 @print_decorator
-def filter_enrollment_date(manually_filter):
+def filter_enrollment_date(driver, manually_filter):
     """ If manually_filter, this clicks the date filter button and waits for user input before continuing """
     if not manually_filter:
         apply = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.CSS_SELECTOR, 'button[form="filter-panel-form"]'))
+            EC.element_to_be_clickable((By.CSS_SELECTOR, APPLY_FILTERS_BUTTON_SELECTOR))
         )
         apply.click()
         return
@@ -221,7 +446,57 @@ def filter_enrollment_date(manually_filter):
     element.click()
     input("Please apply any additional filters and hit apply. Once you see the table loaded, please hit enter in this terminal")
 
-def check_and_click_next_button():
+@print_decorator
+def filter_enrollments(driver, courses, status_list, manually_filter):
+    """ Apply the course, status and date filters on the enrollments page """
+    filtering(driver, courses)
+
+    # skip enrollment status filtering if all statuses are selected (redundant)
+    if(set(status_list) != set(ENROLLMENT_STATUSES)):
+        filter_enrollment_status(driver, status_list)
+    
+    filter_enrollment_date(driver, manually_filter)
+
+def session_expired(driver):
+    """ True if the browser is on the login page or the analytics page is asking to login again """
+    return 'new_analytics' not in driver.current_url or len(driver.find_elements(By.XPATH, LOGIN_LINK_XPATH)) > 0
+
+def on_first_page(driver):
+    """ True if the table shows its first page, or has only one page so there's no pagination """
+    current_page = driver.find_elements(By.CSS_SELECTOR, CURRENT_PAGE_BUTTON_SELECTOR)
+    return len(current_page) == 0 or current_page[0].text.strip() == '1'
+
+@print_decorator
+def refresh_enrollment_filters(driver):
+    """
+    Load the enrollments again with the filters that are still applied in the browser by clicking apply in the filter panel,
+    instead of selecting every course and status again. Returns False if the session expired or the table wasn't reloaded on its first page,
+    the filters then have to be applied from the start.
+    """
+    try:
+        if session_expired(driver):
+            print("SESSION EXPIRED")
+            return False
+
+        wait = WebDriverWait(driver, 10)
+        if not any(button.is_displayed() for button in driver.find_elements(By.CSS_SELECTOR, APPLY_FILTERS_BUTTON_SELECTOR)):
+            wait.until(EC.element_to_be_clickable((By.XPATH, SHOW_FILTERS_BUTTON_XPATH))).click()
+        apply_button = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, APPLY_FILTERS_BUTTON_SELECTOR)))
+        # The last run usually ended on the first page too, so wait for the table it read to be replaced before reading it again
+        old_tables = driver.find_elements(By.CSS_SELECTOR, 'table tbody')
+        apply_button.click()
+
+        refresh_wait = WebDriverWait(driver, 10, poll_frequency=FILTER_POLL_FREQUENCY)
+        if len(old_tables) > 0:
+            refresh_wait.until(EC.staleness_of(old_tables[0]))
+        # Applying the filters reloads the table from its first page
+        refresh_wait.until(on_first_page)
+        return True
+    except (TimeoutException, NoSuchElementException, StaleElementReferenceException):
+        print("COULDN'T REFRESH THE FILTERS, APPLYING THEM AGAIN")
+        return False
+
+def check_and_click_next_button(driver):
     """ If the next button exists, click it and return True, else return False"""
     # Find the span element containing the buttons
     try:
@@ -242,7 +517,7 @@ def check_and_click_next_button():
     except NoSuchElementException:
         return False
     
-def find_and_click_next_page():
+def find_and_click_next_page(driver):
     """If there is more than one page of results, find the next page <button> and click it."""
 
     try:
@@ -253,6 +528,7 @@ def find_and_click_next_page():
             
         if button_next_page:
             print(f"Navigating to page {button_next_page.text}...")
+            instrumentation.count('next_page_clicks')
             driver.execute_script("arguments[0].click();", button_next_page)
             return True
         
@@ -261,173 +537,540 @@ def find_and_click_next_page():
         print("No additional pages found. Proceeding...")
         return False
         
-def convert_numeric_columns(df):
+# Runs in the browser and returns every row of the table as compact JSON, each cell is
+# [data-testid, text, aria-labels of its spans, text of its first screenReaderContent span]
+EXTRACT_TABLE_SCRIPT = """
+const tbody = document.querySelector('table tbody');
+if (!tbody) {
+    return '[]';
+}
+const rows = Array.from(tbody.querySelectorAll('tr'), (tr) =>
+    Array.from(tr.querySelectorAll('td[data-testid], th[data-testid]'), (td) => {
+        const spans = Array.from(td.querySelectorAll('span'));
+        const screenReader = spans.find((span) => /screenReaderContent/i.test(span.getAttribute('class') || ''));
+        return [
+            td.getAttribute('data-testid'),
+            td.textContent,
+            spans.filter((span) => span.hasAttribute('aria-label')).map((span) => span.getAttribute('aria-label')),
+            screenReader ? screenReader.textContent : null
+        ];
+    })
+);
+return JSON.stringify(rows);
+"""
+
+EXTRACT_MODES = ['script', 'html']
+
+class TableNotLoaded(Exception):
+    """ A page after the first didn't show its table, the scrape can't tell that apart from the end of the table """
+
+def read_table_page(driver, extract_mode):
     """
-    An issue with excel is that it will automatically convert numeric data so the raw data and excel data will be considered different,
-    Convert the numeric columns so the values compare correctly.
+    Read the table on the current page, returns None if there's no table.
+    In script mode the cells are collected in the browser with one call, in html mode this is the whole page source.
     """
-    for column in df.columns:
+    with instrumentation.stage('read_table_page'):
         try:
-            df[column] = pd.to_numeric(df[column], errors='raise')
-        except (ValueError, TypeError):
-            pass  # Ignore columns that cannot be converted to numeric
+            WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, 'table')))
+        except TimeoutException:
+            print("NO DATA FOUND.")
+            return None
+        
+        if extract_mode == 'script':
+            return json.loads(driver.execute_script(EXTRACT_TABLE_SCRIPT))
+        return driver.page_source
 
-    return df
+def on_page(driver, page_number):
+    """ True if the table's pagination shows page_number as the current page """
+    current_page = driver.find_elements(By.CSS_SELECTOR, CURRENT_PAGE_BUTTON_SELECTOR)
+    return len(current_page) > 0 and current_page[0].text.strip() == str(page_number)
 
-def extract_table_data(table_data):
-    """ Extract aria-labels or text, assumes page has a table, uses the data-testid property as the column header """
-    try:
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, 'table')))
-    except TimeoutException:
-        print("NO DATA FOUND.")
-        exit()
-    
-    soup = BeautifulSoup(driver.page_source.encode("utf-8"), 'html.parser')
+def live_pages(driver, table, extract_mode, record_dir=None, first_page=1):
+    """
+    Yields (extract_mode, payload) for every page of the table shown in the browser from first_page on, saving a snapshot of each page if record_dir is set.
+    The pages before first_page are clicked through without reading them. Only the first page may have no table (nothing matches the filters),
+    a later page that doesn't load raises TableNotLoaded instead of ending the table early, which would be stored as a full scrape.
+    """
+    page_number = 1
+    while page_number < first_page:
+        if find_and_click_next_page(driver) == False:
+            return
+        page_number += 1
+        # The next click is worked out from the current page, so wait until the table has moved
+        WebDriverWait(driver, 10, poll_frequency=FILTER_POLL_FREQUENCY, ignored_exceptions=[StaleElementReferenceException]).until(lambda driver: on_page(driver, page_number))
 
-    table = soup.find('table') 
-    tbody = table.find('tbody')
-    for row in tbody.find_all('tr'):
+    while True:
+        payload = read_table_page(driver, extract_mode)
+        if payload is None:
+            if page_number > 1:
+                raise TableNotLoaded(f"PAGE {page_number} OF {table} DIDN'T LOAD")
+            break
+        instrumentation.count(f'{table}_pages')
+        if record_dir:
+            snapshots.save_page(record_dir, table, page_number, extract_mode, payload)
+        yield (extract_mode, payload)
 
-        row_data = {}
-        
-        # iterate over each column in the row
-        td: Tag
-        for td in row.find_all(['td', 'th']):
-            # getting the column's label from data-testid attribute
-            if 'data-testid' in td.attrs:
-                
-                label = td['data-testid']
-
-                #spans_with_aria_labels = td.find_all('span', attrs={'aria-label': True})
-
-                if label == 'student_name':
-                    spans_with_aria_labels = td.find_all(lambda tag: tag.name == 'span' and tag.has_attr('aria-label'))
-
-                    search_string = td.text
-                    name_regex = '(^[0-9A-Za-z\\u0100-\\u017FÀ-ÖØ-öø-ÿ\\s\\-\\(\\)\'\\.]+)'
-                    email_regex = '([A-z0-9\\.\\#\\-\\_\\|]+@[A-z0-9\\.\\-]{4,})'
-                    full_regex = f'{name_regex}(#[0-9]+)(\\s\\|\\s)?{email_regex}?'
-
-                    full_match = re.search(full_regex, search_string)
-
-                    if full_match:
-                        name_found = False
-                        email_found = False
-                        
-                        # if <span> with aria-label exists, get name and/or email from that
-                        if len(spans_with_aria_labels) > 0:
-                            for span in spans_with_aria_labels:
-                                name_match = re.search(name_regex, span['aria-label'], re.I)
-                                email_match = re.search(email_regex, span['aria-label'], re.I)
-                                if name_match:
-                                    row_data[f'{label}_0'] = name_match.group(1)
-                                    name_found = True
-                                if email_match:
-                                    row_data[f'{label}_1'] = email_match.string
-                                    email_found = True 
-                        
-                        # check if the full name and/or email were found in a span's aria-label property
-                        # if not, get from innerText match
-                        if name_found is False:
-                            row_data[f'{label}_0'] = full_match.group(1)
-                        if email_found is False:
-                            if(len(full_match.groups()) > 1):
-                                row_data[f'{label}_1'] = ''.join(map(str, full_match.groups()[1:]))
-                            else:
-                                row_data[f'{label}_1'] = '—'
-                        # otherwise, try to get name and/or email from td contents
-                        # else:
-                        #     if len(full_match.groups()) > 1:
-                        #         row_data[f'{label}_0'] = full_match.group(1)
-                        #         row_data[f'{label}_1'] = ''.join(map(str,full_match.groups())[1:])
-                        #     else:
-                        #         row_data[f'{label}_1'] = '—'
-                    # if no regex match for td innerText, insert full innerText into first column
-                    else:
-                        row_data[f'{label}_0'] = search_string
-                elif label == 'product_name':
-                    span_with_aria_label = td.find(lambda tag: tag.name == 'span' and tag.has_attr('aria-label'))
-
-                    # if truncated text, get full listing name from aria-label and id from innerText
-                    if span_with_aria_label:
-                        row_data[f'{label}_0'] = span_with_aria_label['aria-label']
-
-                        id_pattern = re.compile('[0-9]{4,}$')
-
-                        row_data[f'{label}_1'] = id_pattern.search(td.text).group(0)
-                    
-                    # if no truncated text, get listing name and id from innerText
-                    else:
-                        id_pattern = re.compile('[0-9]{4,}$')
-
-                        match = id_pattern.search(td.text)
-
-                        if match:
-                            listing_id = match.group(0)
-
-                            screen_reader_span = td.find_all("span", class_=re.compile("screenReaderContent", re.IGNORECASE), limit=1)
-
-                            # only listing names that overflow the cell contain a <span> element with the ...-screenReaderContent class
-                            if len(screen_reader_span) > 0:
-                                listing_name = screen_reader_span[0].text
-                            else:
-                                listing_name = td.text.replace(listing_id, "")
-                            
-                            row_data[f'{label}_0'] = listing_name
-                            row_data[f'{label}_1'] = listing_id
-                        else:
-                            row_data[f'{label}_0'] = td.text
-
-                else:
-                    row_data[label] = td.text
-
-        table_data.append(row_data)
+        if find_and_click_next_page(driver) == False:
+            break
+        page_number += 1
+
+def extract_table_data(table_data, extract_mode, payload):
+    """ Extract aria-labels or text from one page read by read_table_page, uses the data-testid property as the column header """
+    with instrumentation.stage(f'parse_page[{extract_mode}]'):
+        if extract_mode == 'script':
+            rows = table_parser.rows_from_cells(payload)
+        else:
+            rows = table_parser.parse_table_html(payload)
+
+    table_data.extend(rows)
     return table_data
 
+def scrape_filters(args):
+    """ The filters each table is scraped with, a scrape can only stop early if the table was last scraped with the same filters """
+    return {
+        raw_store.ENROLLMENTS: {'courses': sorted(args.courses), 'status': sorted(args.status)},
+        raw_store.USERS: {},
+    }
+
+def scrape_incrementally(table, filters, full, manually_filter):
+    """ True if the table was scraped with the same filters before, so scraping can stop at the first page of stored rows """
+    # Manual filters aren't known to the script so they can't be compared
+    if full or manually_filter:
+        return False
+
+    watermark = raw_store.read_watermark(table)
+    if watermark is None or watermark['filters'] != filters:
+        return False
+
+    print(f"ONLY SCRAPING NEW {table}. LAST SCRAPED {watermark['synced_at']}, LAST FULL SCRAPE {watermark['full_synced_at']}")
+    return True
+
+def until_stored_page(table, pages):
+    """
+    Pass the pages through until one that only has rows already in the raw data store, the table lists the newest rows first
+    so the pages after it were all scraped before. Stopping the generator also stops live_pages from clicking to the next page.
+    The page is checked before it's passed on, --stream stores each page as soon as it gets it.
+    """
+    for (extract_mode, payload) in pages:
+        df = schema.apply_schema(pd.DataFrame(extract_table_data([], extract_mode, payload)), table)
+        only_stored = raw_store.all_rows_stored(table, df)
+        yield (extract_mode, payload)
+
+        if only_stored:
+            print(f"ONLY STORED {table} ON THIS PAGE, SKIPPING THE REST")
+            return
+
+def table_pages(driver, table, extract_mode, record_dir=None, session=None, incremental=False, first_page=1, filters=None):
+    """ Pages of the open table from first_page on, from the bulk export (a list of the whole table) if session is set and first_page is 1 """
+    if session is not None and first_page > 1:
+        print(f"RESUMING {table} FROM PAGE {first_page} OF THE TABLE, NOT USING THE BULK EXPORT")
+    elif session is not None:
+        try:
+            pages = bulk_export.export_pages(session, table, filters)
+        except bulk_export.BulkExportError as e:
+            print(f"BULK EXPORT OF {table} FAILED, SCRAPING THE TABLE INSTEAD. Error message {e}")
+        else:
+            if record_dir:
+                for page_number, (mode, payload) in enumerate(pages, start=1):
+                    snapshots.save_page(record_dir, table, page_number, mode, payload)
+            return pages
+
+    pages = live_pages(driver, table, extract_mode, record_dir, first_page)
+    return until_stored_page(table, pages) if incremental else pages
+
+def checkpointed_pages(state, table, open_pages):
+    """ The pages saved in the checkpoint, then open_pages(next page) for the rest saved as they're read, a bulk export is saved whole first """
+    if state is None:
+        yield from open_pages(1)
+        return
+
+    yield from checkpoint.saved_pages(table)
+    if not checkpoint.table_finished(state, table):
+        pages = open_pages(checkpoint.page_count(table) + 1)
+        if isinstance(pages, list):
+            yield from list(checkpoint.save_pages(state, table, pages))
+        else:
+            yield from checkpoint.save_pages(state, table, pages)
+
+def enrollment_pages(driver, args, session, incremental, first_page=1):
+    """ Open the enrollments page filtered with the arguments and return the table's pages from first_page """
+    if not driver.current_url.startswith(ENROLLMENTS_URL):
+        driver.get(ENROLLMENTS_URL)
+    filter_enrollments(driver, args.courses, args.status, args.mfe)
+    return table_pages(driver, raw_store.ENROLLMENTS, args.extract_mode, args.record, None if args.mfe else session, incremental, first_page, scrape_filters(args)[raw_store.ENROLLMENTS])
+
+def user_pages(driver, args, session, incremental, first_page=1):
+    """ Open the users page and return the table's pages from first_page """
+    open_users_page(driver, args.mfu)
+    return table_pages(driver, raw_store.USERS, args.extract_mode, args.record, None if args.mfu else session, incremental, first_page)
+
+def scrape_enrollment_shard(shard_driver, cookies, courses, status_list, extract_mode, incremental=False):
+    """ Runs in its own thread: log the headless shard browser in with the cookies, filter to the shard's courses and read every page """
+    try:
+        copy_cookies(cookies, shard_driver)
+        shard_driver.get(ENROLLMENTS_URL)
+        WebDriverWait(shard_driver, 30).until(EC.url_contains('enrollments'))
+        filter_enrollments(shard_driver, courses, status_list, False)
+        pages = live_pages(shard_driver, raw_store.ENROLLMENTS, extract_mode)
+        return list(until_stored_page(raw_store.ENROLLMENTS, pages) if incremental else pages)
+    finally:
+        shard_driver.quit()
+
+def start_enrollment_shards(executor, driver, courses, status_list, extract_mode, shard_count, incremental=False):
+    """
+    Split the courses between shard_count headless browsers that share driver's login, each one scrapes its courses in the executor.
+    Returns the futures of the shards' pages.
+    """
+    shards = [shard for shard in (courses[i::shard_count] for i in range(shard_count)) if len(shard) > 0]
+    cookies = driver.get_cookies()
+
+    # The browsers are started one at a time so the driver manager only downloads the driver once
+    shard_drivers = []
+    try:
+        for _ in shards:
+            shard_drivers.append(instrumentation.count_driver_commands(create_driver(headless=True, use_profile=False)))
+    except Exception:
+        # The shards never started, so nothing else quits the browsers that did
+        for shard_driver in shard_drivers:
+            shard_driver.quit()
+        raise
+    for shard in shards:
+        print("STARTING SHARD FOR", " ".join(shard))
+    return [executor.submit(scrape_enrollment_shard, shard_driver, cookies, shard, status_list, extract_mode, incremental) for shard_driver, shard in zip(shard_drivers, shards)]
+
+def merge_shard_pages(shard_futures, record_dir=None):
+    """ Wait for the shards and put their pages together, numbering the snapshots across all shards """
+    pages = [page for future in shard_futures for page in future.result()]
+    if record_dir:
+        for page_number, (mode, payload) in enumerate(pages, start=1):
+            snapshots.save_page(record_dir, raw_store.ENROLLMENTS, page_number, mode, payload)
+    return pages
+
+class NoEnrollmentsFound(Exception):
+    """ The scrape found no enrollments, so there's nothing to distribute """
+
 @print_decorator
-def extract_enrollment_table():
-    """ This accumulates the data on each page """
+def extract_enrollment_table(pages):
+    """ This accumulates the data on each page, pages is live_pages or snapshots.load_pages """
     table_data = []
     
-    while True:
-        table_data = extract_table_data(table_data)
-        if find_and_click_next_page() == False:
-            break
+    for (extract_mode, payload) in pages:
+        table_data = extract_table_data(table_data, extract_mode, payload)
 
-    # Create a DataFrame from your data
-    df = pd.DataFrame(table_data)
-    
-    df = convert_numeric_columns(df)
-    return append_data_to_excel(os.environ.get("RAW_DATA_PATH_ENROLLMENTS"), df)
+    if len(table_data) == 0:
+        raise NoEnrollmentsFound()
 
+    # Create a DataFrame from your data, pages from different shards can overlap so drop the duplicates
+    df = pd.DataFrame(table_data).drop_duplicates(ignore_index=True)
+    
+    # Typed columns so the values compare the same as the stored rows
+    df = schema.apply_schema(df, raw_store.ENROLLMENTS)
+    return append_data_to_store(raw_store.ENROLLMENTS, df)
 
 @print_decorator
-def extract_users(manually_filter_users):
-    """ 
-    This will go to the users page, and optionally pause to allow for manual user filtering
-    It will then go through each page and put the data in the excel
-    """
-    driver.get('https://courses.cpe.ubc.ca/new_analytics/users')
+def open_users_page(driver, manually_filter_users):
+    """ This will go to the users page, and optionally pause to allow for manual user filtering """
+    driver.get(USERS_URL)
 
     if manually_filter_users:
         button = WebDriverWait(driver, 10).until(EC.visibility_of_element_located((By.CSS_SELECTOR, 'button[data-automation="Filter__Show__Filters__Button"]')))
         button.click()
         input("Please apply any additional filters and hit apply. Once you see the table loaded, please hit enter in this terminal")
 
+@print_decorator
+def stream_enrollments(pages, distributor):
+    """
+    Store each page of enrollments as soon as it's read and hand it to a thread that distributes it while the next page loads.
+    The queue between them is bounded so scraping waits when distribution falls behind, then every excel is saved once at the end.
+    """
+    batches = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    errors = []
+
+    def distribute_batches():
+        while (df := batches.get()) is not None:
+            # Keep taking batches after an error so the scraping side never blocks on a full queue
+            if len(errors) == 0:
+                try:
+                    distributor.add(df)
+                except Exception as e:
+                    errors.append(e)
+
+    distribution_thread = threading.Thread(target=distribute_batches, daemon=True)
+    distribution_thread.start()
+    row_count = 0
+    try:
+        for (extract_mode, payload) in pages:
+            rows = extract_table_data([], extract_mode, payload)
+            if len(rows) == 0:
+                continue
+
+            df = schema.apply_schema(pd.DataFrame(rows), raw_store.ENROLLMENTS).drop_duplicates(ignore_index=True)
+            append_data_to_store(raw_store.ENROLLMENTS, df)
+            batches.put(df)
+            row_count += len(df)
+    finally:
+        batches.put(None)
+        distribution_thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+    if row_count == 0:
+        raise NoEnrollmentsFound()
+    distributor.finish()
+
+@print_decorator
+def extract_users(pages):
+    """ This will go through each page of users and put the data in the raw data store, pages is live_pages or snapshots.load_pages """
     table_data = []
     
-    while True:
-        table_data = extract_table_data(table_data)
-        if find_and_click_next_page() == False:
-            break
+    for (extract_mode, payload) in pages:
+        table_data = extract_table_data(table_data, extract_mode, payload)
+
+    # The users already in the store are still used for distributing, so no users isn't a reason to stop
+    if len(table_data) == 0:
+        print("NO USERS FOUND")
+        return
 
     # Create a DataFrame from your data
     df = pd.DataFrame(table_data)
-    df = convert_numeric_columns(df)
+    df = schema.apply_schema(df, raw_store.USERS)
+
+    # Append data to the raw data store
+    append_data_to_store(raw_store.USERS, df)
+
+def scrape_users_table(driver, manually_filter, extract_mode, record_dir=None, session=None, incremental=False):
+    """ Open the users page and store every user in the table """
+    open_users_page(driver, manually_filter)
+    extract_users(table_pages(driver, raw_store.USERS, extract_mode, record_dir, None if manually_filter else session, incremental))
+
+def users_to_look_up(enrollment_df):
+    """
+    The enrolled students that aren't in the users store, or were last stored or looked up more than STALE_USER_DAYS ago.
+    Returns {user key: email}, the key is the lowercase student_name_1 that distribute joins users on.
+    """
+    last_seen = raw_store.last_seen(raw_store.USERS, 'student_name_1')
+    stale_before = (datetime.now() - timedelta(days=STALE_USER_DAYS)).isoformat(timespec='seconds')
+
+    lookups = {}
+    for value in enrollment_df['student_name_1'].dropna().astype(str):
+        key = value.lower().strip()
+        email_match = table_parser.EMAIL_PATTERN.search(key)
+        if email_match and last_seen.get(key, '') < stale_before:
+            lookups[key] = email_match.group(1)
+    return lookups
+
+def student_listed(driver, email):
+    """ True once the users table shows a row for the email, i.e. the search results have loaded """
+    try:
+        return any(email in cell.text.lower() for cell in driver.find_elements(By.CSS_SELECTOR, 'td[data-testid="student_name"]'))
+    except StaleElementReferenceException:
+        return False
+
+class UserSearchUnavailable(Exception):
+    """ The users page's search box (USER_SEARCH_INPUT_SELECTOR) didn't show up """
+
+def search_users(driver, lookups, extract_mode, record_dir=None, found=None):
+    """
+    Yields (extract_mode, payload) with the search results for each user in lookups ({user key: email}), searching the users page by email.
+    The keys of the users that are found are added to found, users that aren't are looked up again next run.
+    """
+    driver.get(USERS_URL)
+    search_wait = WebDriverWait(driver, 10, poll_frequency=FILTER_POLL_FREQUENCY)
+
+    for page_number, (key, email) in enumerate(sorted(lookups.items()), start=1):
+        try:
+            search_input = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, USER_SEARCH_INPUT_SELECTOR)))
+        except TimeoutException:
+            raise UserSearchUnavailable(f"NO SEARCH BOX MATCHING {USER_SEARCH_INPUT_SELECTOR} ON THE USERS PAGE")
+        search_input.clear()
+        search_input.send_keys(email)
 
-    # Append data to Excel file
-    append_data_to_excel(os.environ.get("RAW_DATA_PATH_USERS"), df)
+        try:
+            search_wait.until(lambda driver: student_listed(driver, email))
+        except TimeoutException:
+            print("USER NOT FOUND", email)
+            instrumentation.count('users_not_found')
+            continue
+
+        payload = read_table_page(driver, extract_mode)
+        if payload is None:
+            continue
+        if record_dir:
+            snapshots.save_page(record_dir, raw_store.USERS, page_number, extract_mode, payload)
+        if found is not None:
+            found.append(key)
+        instrumentation.count('users_looked_up')
+        yield (extract_mode, payload)
+
+def look_up_users(driver, enrollment_df, extract_mode, record_dir=None, session=None):
+    """ Store the users of the scraped enrollments by searching for them, or the whole users table if there are too many to search for """
+    lookups = users_to_look_up(enrollment_df)
+    if len(lookups) == 0:
+        print("EVERY ENROLLED USER IS ALREADY STORED")
+    elif len(lookups) > MAX_USER_LOOKUPS:
+        print(f"{len(lookups)} USERS TO LOOK UP, SCRAPING THE WHOLE USERS TABLE INSTEAD")
+        scrape_users_table(driver, False, extract_mode, record_dir, session)
+    else:
+        print(f"LOOKING UP {len(lookups)} USERS")
+        found = []
+        try:
+            extract_users(search_users(driver, lookups, extract_mode, record_dir, found))
+        except UserSearchUnavailable as e:
+            print(f"COULDN'T SEARCH FOR USERS, SCRAPING THE WHOLE USERS TABLE INSTEAD. Error message {e}")
+            scrape_users_table(driver, False, extract_mode, record_dir, session)
+            return
+        # Only saved once the users are stored, a run that fails part way looks them up again
+        raw_store.save_lookups(raw_store.USERS, found)
     
+def save_watermarks(filters, incremental, manually_filtered, lookup_users):
+    """ Both tables are in the store now, the next run with the same filters can stop at the first page of stored rows """
+    # Looking up users doesn't go through the users table, so it doesn't move the users watermark
+    scraped_tables = [raw_store.ENROLLMENTS] if lookup_users else list(filters)
+    for table in scraped_tables:
+        if not manually_filtered[table]:
+            raw_store.save_watermark(table, filters[table], full=not incremental[table])
+
+def export_and_distribute(args, enrollment_df, run_id=None):
+    """ The end of every run, --stream has distributed the enrollments already. run_id is the distribution history's run, a new one if not given """
+    if args.export_raw:
+        raw_store.export_to_excel(raw_store.ENROLLMENTS)
+        raw_store.export_to_excel(raw_store.USERS)
+
+    if not args.stream:
+        with instrumentation.stage('distribute_enrollment_data'):
+            distribute.distribute_enrollment_data(enrollment_df, os.environ.get("PROCESSED_DATA_PATH"), args.workers, run_id=run_id)
+
+def open_serve_windows(driver):
+    """ The enrollments tab and a new users tab for --serve, any other tabs are closed """
+    (enrollments_window, *other_windows) = driver.window_handles
+    for window in other_windows:
+        driver.switch_to.window(window)
+        driver.close()
+    driver.switch_to.window(enrollments_window)
+    driver.switch_to.new_window('tab')
+    return {raw_store.ENROLLMENTS: enrollments_window, raw_store.USERS: driver.current_window_handle}
+
+def driver_alive(driver):
+    """ False once the browser was closed or crashed, a quit driver fails with connection errors instead of WebDriverException """
+    try:
+        driver.window_handles
+        return True
+    except Exception:
+        return False
+
+def serve_run(driver, args, windows, filters_applied):
+    """
+    One scrape and distribution of --serve. The enrollments tab keeps its filters from the last run and only reloads the table,
+    if they aren't applied or the session expired it logs in again and applies them from the start. Returns if the filters are applied.
+    """
+    driver.switch_to.window(windows[raw_store.ENROLLMENTS])
+    if not (filters_applied and refresh_enrollment_filters(driver)):
+        login(driver, args.headless)
+        filter_enrollments(driver, args.courses, args.status, False)
+
+    # The cookies change when the session is renewed, so the export session is made again every run
+    session = None
+    if args.bulk:
+        session = bulk_export.session_from_driver(driver)
+
+    filters = scrape_filters(args)
+    manually_filtered = {raw_store.ENROLLMENTS: False, raw_store.USERS: False}
+    incremental = {table: scrape_incrementally(table, filters[table], args.full, False) for table in filters}
+
+    try:
+        enrollment_df = extract_enrollment_table(table_pages(driver, raw_store.ENROLLMENTS, args.extract_mode, None, session, incremental[raw_store.ENROLLMENTS], filters=filters[raw_store.ENROLLMENTS]))
+    except NoEnrollmentsFound:
+        # The next run can still find some
+        print("NO ENROLLMENTS FOUND, NOTHING TO DISTRIBUTE")
+        return True
+
+    # The users are read in their own tab so the enrollments tab doesn't lose its filters
+    driver.switch_to.window(windows[raw_store.USERS])
+    if args.lookup_users:
+        look_up_users(driver, enrollment_df, args.extract_mode, None, session)
+    else:
+        scrape_users_table(driver, False, args.extract_mode, None, session, incremental[raw_store.USERS])
+
+    save_watermarks(filters, incremental, manually_filtered, args.lookup_users)
+    export_and_distribute(args, enrollment_df)
+    return True
+
+def keep_alive(driver, window):
+    """ Reload the users tab so the session doesn't time out between --serve runs, an error only means the next run logs in again """
+    try:
+        driver.switch_to.window(window)
+        driver.refresh()
+        instrumentation.count('keep_alive_reloads')
+    except WebDriverException as e:
+        print(f"COULDN'T KEEP THE SESSION ALIVE. Error message {e}")
+
+def serve(args):
+    """
+    Keep one logged in browser open and scrape and distribute every args.serve minutes until Ctrl+C or SIGTERM, which stop after the current run.
+    Each run saves its own run report. A run that fails is reported and the next one starts from the login with the filters applied again,
+    with a new browser if the old one closed.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        print("STOPPING AFTER THE CURRENT RUN, PRESS CTRL+C AGAIN TO STOP NOW")
+        stop.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    driver = None
+    windows = None
+    filters_applied = False
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            print(f"STARTING RUN AT {datetime.now().isoformat(timespec='seconds')}")
+            try:
+                if driver is None or not driver_alive(driver):
+                    with instrumentation.stage('create_driver'):
+                        driver = instrumentation.count_driver_commands(create_driver(headless=args.headless))
+                    windows = None
+                if windows is None:
+                    windows = open_serve_windows(driver)
+                    filters_applied = False
+                filters_applied = serve_run(driver, args, windows, filters_applied)
+            except LoginFailed:
+                # Nobody is there to login again, stop serving like a normal run would
+                raise
+            except Exception:
+                traceback.print_exc()
+                print("RUN FAILED, THE NEXT RUN STARTS AGAIN FROM THE LOGIN")
+                instrumentation.count('serve_runs_failed')
+                (windows, filters_applied) = (None, False)
+
+            save_run_report(vars(args))
+            instrumentation.reset()
+
+            next_run = started + args.serve * 60
+            print(f"NEXT RUN AT {(datetime.now() + timedelta(seconds=max(next_run - time.monotonic(), 0))).isoformat(timespec='seconds')}")
+            while not stop.wait(max(min(KEEP_ALIVE_SECONDS, next_run - time.monotonic()), 0)) and time.monotonic() < next_run:
+                if windows is not None:
+                    keep_alive(driver, windows[raw_store.USERS])
+    finally:
+        # login quits the browser itself when the login failed
+        if driver is not None and driver_alive(driver):
+            driver.quit()
+        print("STOPPED SERVING")
+
+def save_run_report(arguments):
+    path = instrumentation.save_report(arguments=arguments)
+    print("SAVED RUN REPORT TO", path)
+
+def save_profile(profiler):
+    """ Save the cProfile stats next to the run report and print the slowest functions """
+    profiler.disable()
+    path = instrumentation.report_path().replace("run_report_", "run_profile_").replace(".json", ".prof")
+    profiler.dump_stats(path)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    print("SAVED PROFILE TO", path)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This Script uses Selenium to login to Canvas Catalog and extracts enrollments + users')
     
@@ -436,19 +1079,135 @@ if __name__ == "__main__":
     parser.add_argument('--mfu', action='store_true', help='Manually Filter Users. Include this argument if you want the bot to pause when filtering users')
     parser.add_argument('--courses', nargs='+', choices=VALID_COURSES, default=VALID_COURSES, help='Include courses that you want selected. Example: --courses CACE CNR CVA. Defaults to all courses')
     parser.add_argument('--status', nargs='+', choices=ENROLLMENT_STATUSES, default=ENROLLMENT_STATUSES, help='Indicate which enrollment statuses you wish to filter for. Example: --status Active Completed. Defaults to any status.')
+    parser.add_argument('--extract-mode', choices=EXTRACT_MODES, default='script', help='How each table page is read. script collects the cells in the browser with one call per page, html parses the full page source. Defaults to script')
+    parser.add_argument('--export-raw', action='store_true', help='Also export the raw enrollments and users to the excels in 0RawData after scraping')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to update the registration excels in parallel, one excel per process. Example: --workers 4. Defaults to 1')
+    parser.add_argument('--record', metavar='DIR', help='Save a snapshot of every scraped page and the filters used into DIR so the run can be replayed with --replay')
+    parser.add_argument('--replay', metavar='DIR', help='Skip the browser and run extraction and distribution on the snapshots saved in DIR by --record')
+    parser.add_argument('--headless', action='store_true', help='Run the browser without a window. Needs BROWSER_PROFILE_DIR in .env and one normal run to login first, can\'t be used with --mfe or --mfu')
+    parser.add_argument('--shards', type=int, default=1, help='Split the courses between this many headless browsers that scrape the enrollments at the same time, sharing the login. Not used with --mfe or --bulk. Example: --shards 4. Defaults to 1')
+    parser.add_argument('--lookup-users', action='store_true', help=f'Instead of scraping the whole users table, search the users page for the scraped enrollments whose user isn\'t stored or was stored more than {STALE_USER_DAYS} days ago. Can\'t be used with --mfu')
+    parser.add_argument('--stream', action='store_true', help='Scrape the users first, then distribute each page of enrollments in the background while the next page loads instead of after scraping everything. Can\'t be used with --shards or --lookup-users, --workers isn\'t used')
+    parser.add_argument('--profile', action='store_true', help='Also profile the whole run with cProfile, saved as run_profile_<date>.prof next to the run report. Open it with python -m pstats')
+    parser.add_argument('--full', action='store_true', help='Scrape every page even if the table was scraped with the same filters before. By default the scrape stops at the first page that only has rows already in the raw data store')
+    parser.add_argument('--bulk', action='store_true', help='After login, download the enrollments and users from the analytics export urls in .env instead of clicking through the table pages. Falls back to the table pages if the export fails')
+    parser.add_argument('--serve', type=float, metavar='MINUTES', help=f'Keep the browser logged in and scrape and distribute again every MINUTES until stopped with Ctrl+C. The enrollment filters stay applied between runs and the session is kept alive every {KEEP_ALIVE_SECONDS} seconds. Example: --serve 30. Can\'t be used with --mfe, --mfu, --replay, --record, --shards or --stream')
+    parser.add_argument('--resume', action='store_true', help='Continue the last run that didn\'t finish from its checkpoint instead of scraping from the first page again, if it had the same --courses and --status. Can\'t be used with --mfe, --mfu, --replay, --record, --shards or --serve')
 
     # Parse the command line arguments
     args = parser.parse_args()
+    if args.headless and (args.mfe or args.mfu):
+        parser.error("--headless can't be used with --mfe or --mfu, manual filtering needs the browser window")
+    if args.headless and not BROWSER_PROFILE_DIR:
+        parser.error("--headless needs BROWSER_PROFILE_DIR in .env, a headless browser can only use a login saved in its profile")
+    if args.stream and (args.shards > 1 or args.lookup_users):
+        parser.error("--stream can't be used with --shards or --lookup-users, both need every enrollment before the users")
+    if args.lookup_users and args.mfu:
+        parser.error("--lookup-users can't be used with --mfu, the looked up users aren't filtered")
+    if args.serve is not None and (args.mfe or args.mfu or args.replay or args.record or args.shards > 1 or args.stream):
+        parser.error("--serve can't be used with --mfe, --mfu, --replay, --record, --shards or --stream")
+    if args.serve is not None and args.serve <= 0:
+        parser.error("--serve needs a number of minutes above 0")
+    if args.resume and (args.mfe or args.mfu or args.replay or args.record or args.shards > 1 or args.serve is not None):
+        parser.error("--resume can't be used with --mfe, --mfu, --replay, --record, --shards or --serve, those runs aren't checkpointed")
+
+    # Selenium, pandas and the modules that use them take most of a second to load, they're only imported once the arguments
+    # are parsed so --help and a wrong argument answer straight away
+    from selenium import webdriver
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+    from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException, WebDriverException, SessionNotCreatedException
+    import pandas as pd
+
+    import bulk_export
+    import checkpoint
+    import distribute
+    import raw_store
+    import schema
+    import table_parser
+
+    # The run report is saved however the run ends, exit() included
+    atexit.register(save_run_report, vars(args))
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(save_profile, profiler)
     
-    login()
-    filtering(args.courses)
-
-    # skip enrollment status filtering if all statuses are selected (redundant)
-    if(set(args.status) != set(ENROLLMENT_STATUSES)):
-        filter_enrollment_status(args.status)
-    
-    filter_enrollment_date(args.mfe)
-    enrollment_df = extract_enrollment_table()
-    extract_users(args.mfu)
-
-    distribute.distribute_enrollment_data(enrollment_df, os.environ.get("RAW_DATA_PATH_USERS"), os.environ.get("PROCESSED_DATA_PATH"))
\ No newline at end of file
+    # Only runs filtered with the arguments are checkpointed, manual filters can't be applied again by a resumed run
+    # and the shards hand over their pages all at once
+    state = None
+    enrollment_df = None
+    try:
+        if args.serve is not None:
+            # Every run of serve saves its own report, the one saved at exit only covers stopping
+            serve(args)
+        elif args.replay:
+            print("REPLAYING RUN FILTERED WITH", snapshots.load_filters(args.replay))
+            if args.stream:
+                extract_users(snapshots.load_pages(args.replay, raw_store.USERS))
+                stream_enrollments(snapshots.load_pages(args.replay, raw_store.ENROLLMENTS), distribute.Distributor(os.environ.get("PROCESSED_DATA_PATH")))
+            else:
+                enrollment_df = extract_enrollment_table(snapshots.load_pages(args.replay, raw_store.ENROLLMENTS))
+                extract_users(snapshots.load_pages(args.replay, raw_store.USERS))
+        else:
+            filters = scrape_filters(args)
+            manually_filtered = {raw_store.ENROLLMENTS: args.mfe, raw_store.USERS: args.mfu}
+            shard_run = args.shards > 1 and not (args.mfe or args.bulk)
+            if not (args.mfe or args.mfu or shard_run):
+                state = checkpoint.start(filters, args.resume)
+
+            # A resumed run that has both tables saved only needs the browser to look up users
+            driver = None
+            session = None
+            if state is None or args.lookup_users or not all(checkpoint.table_finished(state, table) for table in filters):
+                with instrumentation.stage('create_driver'):
+                    driver = instrumentation.count_driver_commands(create_driver(headless=args.headless))
+                login(driver, args.headless)
+                if args.record:
+                    snapshots.save_filters(args.record, vars(args))
+
+                # Manual filters only exist in the browser, so only use the bulk export when the filters come from the arguments
+                session = bulk_export.session_from_driver(driver) if args.bulk else None
+
+            incremental = {table: scrape_incrementally(table, filters[table], args.full, manually_filtered[table]) for table in filters}
+
+            if shard_run:
+                with ThreadPoolExecutor(max_workers=args.shards) as executor:
+                    shard_futures = start_enrollment_shards(executor, driver, args.courses, args.status, args.extract_mode, args.shards, incremental[raw_store.ENROLLMENTS])
+
+                    # The main browser scrapes the users while the shards scrape the enrollments
+                    if not args.lookup_users:
+                        scrape_users_table(driver, args.mfu, args.extract_mode, args.record, session, incremental[raw_store.USERS])
+                    enrollment_df = extract_enrollment_table(merge_shard_pages(shard_futures, args.record))
+            elif args.stream:
+                # Every batch is joined with the users as it's distributed, so the users are scraped first
+                extract_users(checkpointed_pages(state, raw_store.USERS, lambda first_page: user_pages(driver, args, session, incremental[raw_store.USERS], first_page)))
+                pages = checkpointed_pages(state, raw_store.ENROLLMENTS, lambda first_page: enrollment_pages(driver, args, session, incremental[raw_store.ENROLLMENTS], first_page))
+                stream_enrollments(pages, distribute.Distributor(os.environ.get("PROCESSED_DATA_PATH"), state['run_id'] if state else None))
+            else:
+                enrollment_df = extract_enrollment_table(checkpointed_pages(state, raw_store.ENROLLMENTS, lambda first_page: enrollment_pages(driver, args, session, incremental[raw_store.ENROLLMENTS], first_page)))
+                if not args.lookup_users:
+                    extract_users(checkpointed_pages(state, raw_store.USERS, lambda first_page: user_pages(driver, args, session, incremental[raw_store.USERS], first_page)))
+
+            if args.lookup_users:
+                look_up_users(driver, enrollment_df, args.extract_mode, args.record, session)
+
+            save_watermarks(filters, incremental, manually_filtered, args.lookup_users)
+
+        if args.serve is None:
+            export_and_distribute(args, enrollment_df, state['run_id'] if state else None)
+        if state is not None:
+            checkpoint.clear()
+    except NoEnrollmentsFound:
+        print("NO ENROLLMENTS FOUND, NOTHING TO DISTRIBUTE")
+        if state is not None:
+            checkpoint.clear()
+    except LoginFailed as e:
+        print(e)
+        exit(1)
+    except BaseException:
+        if state is not None:
+            print("THE RUN DIDN'T FINISH, RUN AGAIN WITH --resume TO CONTINUE WHERE IT STOPPED")
+        raise
@@ -0,0 +1,125 @@
+import io
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+import pandas as pd
+from dotenv import load_dotenv
+
+import instrumentation
+import json_files
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+load_dotenv()
+
+"""
+Cache of the input excels the script only reads (processed_data.xlsx), so a run doesn't parse the whole excel again when it hasn't changed.
+Only the columns that are asked for are read and the copy keeps the types read_excel gave them, saved as Parquet if pyarrow is installed
+and as JSON with its table schema otherwise. Neither runs code when it's read, unlike a pickle. A copy is used while the excel has the same path,
+modified time and size, or the same content hash if only the modified time changed (e.g. the shared drive synced it again).
+Copies are kept in a local .input_cache folder next to this script (or INPUT_CACHE_PATH) rather than on the shared drive, and deleted once
+they're replaced or unused for MAX_AGE_DAYS. Only files the index lists are ever deleted.
+"""
+
+INDEX_FILE = "index.json"
+
+# Cached copies that weren't used for this many days are deleted
+MAX_AGE_DAYS = 14
+
+def cache_folder():
+    return os.environ.get("INPUT_CACHE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".input_cache")
+
+def file_hash(path):
+    """ sha1 of the file's content, read in chunks """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_index(folder):
+    # A broken index only means the copies get made again
+    return json_files.read_json(os.path.join(folder, INDEX_FILE), {})
+
+def save_index(folder, index):
+    json_files.write_json(os.path.join(folder, INDEX_FILE), index)
+
+def write_copy(df, path_without_extension):
+    """ Save df as Parquet, or as JSON if pyarrow isn't installed or can't store a column (e.g. mixed numbers and text) """
+    if pyarrow is not None:
+        try:
+            df.to_parquet(path_without_extension + ".parquet", index=False)
+            return path_without_extension + ".parquet"
+        except (pyarrow.ArrowException, ValueError, TypeError):
+            pass
+    df.to_json(path_without_extension + ".json", orient='table', index=False, date_format='iso')
+    return path_without_extension + ".json"
+
+def read_copy(path):
+    """ Copies in any other format (e.g. pickles made by older versions) are never read """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return pd.read_json(io.StringIO(f.read()), orient='table')
+    raise ValueError("Not a Parquet or JSON copy")
+
+def remove_copy(folder, entry):
+    path = os.path.join(folder, os.path.basename(entry['file']))
+    if os.path.isfile(path):
+        os.remove(path)
+
+def evict(folder, index):
+    """ Delete the copies that weren't used for MAX_AGE_DAYS or whose excel is gone """
+    unused_since = (datetime.now() - timedelta(days=MAX_AGE_DAYS)).isoformat(timespec='seconds')
+    for key, entry in list(index.items()):
+        if entry['used_at'] < unused_since or not os.path.isfile(entry['source']):
+            remove_copy(folder, entry)
+            del index[key]
+
+def read_excel(path, columns):
+    """ pd.read_excel of only these columns (the ones the excel has), from the cached copy while the excel hasn't changed """
+    source = os.path.abspath(path)
+    folder = cache_folder()
+    os.makedirs(folder, exist_ok=True)
+    index = load_index(folder)
+
+    key = json.dumps([source, sorted(columns)])
+    entry = index.get(key)
+    stat = os.stat(source)
+
+    df = None
+    if entry is not None:
+        unchanged = entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+        if not unchanged and entry['sha1'] == file_hash(source):
+            entry.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            unchanged = True
+
+        if unchanged:
+            try:
+                df = read_copy(os.path.join(folder, os.path.basename(entry['file'])))
+            except Exception as e:
+                print(f"COULDN'T READ THE CACHED COPY OF {path}, READING THE EXCEL. Error message {e}")
+                remove_copy(folder, entry)
+        else:
+            remove_copy(folder, entry)
+
+    instrumentation.count('input_cache_hits' if df is not None else 'input_cache_misses')
+    if df is None:
+        wanted = set(columns)
+        df = pd.read_excel(source, usecols=lambda column: column in wanted)
+        sha1 = file_hash(source)
+        name = hashlib.sha1(f"{key}{sha1}".encode("utf-8")).hexdigest()[:16]
+        copy_path = write_copy(df, os.path.join(folder, name))
+        entry = {'source': source, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': sha1, 'file': os.path.basename(copy_path)}
+        print(f"CACHED {path} ({len(df)} ROWS)")
+
+    entry['used_at'] = datetime.now().isoformat(timespec='seconds')
+    index[key] = entry
+    evict(folder, index)
+    save_index(folder, index)
+    return df
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+"""
+Timings and counters for a run, so a slow run can be traced to the stage that got slower.
+Stages record their calls, wall time and CPU time (CPU time is for the whole process, so it includes other threads while the stage runs),
+stages can be nested so e.g. parse_page time is also part of extract_enrollment_table. Counters are plain running totals.
+get_data.py writes the report as run_report_<date>.json next to the enrollment history files at the end of every run.
+"""
+
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_started_at = datetime.now()
+_started_wall = time.perf_counter()
+_started_cpu = time.process_time()
+
+def reset():
+    """ Start a new report, used by the distribute worker processes so they only report their own work """
+    global _started_at, _started_wall, _started_cpu
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _started_at = datetime.now()
+        _started_wall = time.perf_counter()
+        _started_cpu = time.process_time()
+
+def add_stage_time(name, wall_seconds, cpu_seconds, calls=1):
+    with _lock:
+        stage_times = _stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+        stage_times['calls'] += calls
+        stage_times['wall_seconds'] += wall_seconds
+        stage_times['cpu_seconds'] += cpu_seconds
+
+@contextmanager
+def stage(name):
+    """ Time the code inside the with block as one call of the stage """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+def count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def count_driver_commands(driver):
+    """ Count every WebDriver round trip the driver makes (by command name), including the ones made through its elements """
+    execute = driver.execute
+
+    def counted_execute(driver_command, params=None):
+        count('webdriver_commands')
+        count(f'webdriver_command.{driver_command}')
+        return execute(driver_command, params)
+
+    driver.execute = counted_execute
+    return driver
+
+def report():
+    """ Everything recorded so far as a JSON-able dict """
+    with _lock:
+        return {
+            'started_at': _started_at.isoformat(timespec='seconds'),
+            'wall_seconds': round(time.perf_counter() - _started_wall, 3),
+            'cpu_seconds': round(time.process_time() - _started_cpu, 3),
+            'stages': {name: {**times, 'wall_seconds': round(times['wall_seconds'], 3), 'cpu_seconds': round(times['cpu_seconds'], 3)} for name, times in _stages.items()},
+            'counters': dict(_counters),
+        }
+
+def merge(other_report):
+    """ Add the stages and counters of a report from another process (see reset) """
+    for name, times in other_report['stages'].items():
+        add_stage_time(name, times['wall_seconds'], times['cpu_seconds'], times['calls'])
+    for name, amount in other_report['counters'].items():
+        count(name, amount)
+
+def report_path():
+    """ run_report_<date>.json in the same folder as the enrollment history files """
+    history_folder = os.path.dirname(os.environ.get('ENROLLMENTS_HISTORY_PATH') or '')
+    return os.path.join(history_folder, f"run_report_{_started_at.strftime('%Y%m%d_%H%M%S')}.json")
+
+def save_report(path=None, **extra):
+    """ Save the report with any extra fields (e.g. the arguments of the run), returns the path """
+    path = path or report_path()
+    with open(path, 'w') as f:
+        json.dump({**report(), 'finished_at': datetime.now().isoformat(timespec='seconds'), **extra}, f, indent=2)
+    return path
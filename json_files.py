@@ -0,0 +1,22 @@
+import os
+import json
+
+"""
+Small JSON state files (the checkpoint's run.json, the input cache's index.json) that are rewritten while a run is going.
+"""
+
+def read_json(path, default=None):
+    """ The file's data, default if it's missing or can't be read """
+    if not os.path.isfile(path):
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json(path, data):
+    """ Written to a temporary file first and swapped in, so a run that's stopped part way never leaves half a file """
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,403 @@
+import sqlite3
+import pandas as pd
+from dotenv import load_dotenv
+import os
+import glob
+import json
+import math
+import hashlib
+import argparse
+from contextlib import closing
+from datetime import datetime
+
+import schema
+
+load_dotenv()
+
+"""
+Append-only store for the raw enrollments and users scraped from Canvas Catalog.
+Every row is saved once with a hash of its values, the hash has a unique index so new scrapes only insert the rows that are actually new
+instead of reading and rewriting the whole history. The store is kept on the local disk, the excels in 0RawData on the shared drive
+are only an export of it, see export_to_excel.
+"""
+
+ENROLLMENTS = "enrollments"
+USERS = "users"
+
+# One row per scraped table with the filters of the last finished scrape, see read_watermark
+WATERMARKS = "watermarks"
+# When single rows were last looked up (e.g. a user searched by email), so rows that didn't change aren't looked up again every run
+LOOKUPS = "lookups"
+# The distribution ledger, one row per enrollment written to a registration excel with a hash of the data that was written
+DISTRIBUTED = "distributed"
+# Every row each run distributed, what used to be a new excel in 0EnrollmentHistory per run, see read_history
+DISTRIBUTION_HISTORY = "distribution_history"
+
+# Bumped when row_hash changes, connect rehashes the stored rows of a store with an older version (kept in sqlite's user_version)
+HASH_VERSION = 1
+
+# What an enrollment is in the ledger: the lowercase email (or name if there's no email), program code, sheet session and listing id
+LEDGER_KEY = ['user_key', 'program', 'session', 'listing_id']
+
+# The excels the store replaces, their rows are imported the first time the store is used and they are where export_to_excel writes to
+EXCEL_PATHS = {
+    ENROLLMENTS: os.environ.get("RAW_DATA_PATH_ENROLLMENTS"),
+    USERS: os.environ.get("RAW_DATA_PATH_USERS"),
+}
+
+# Defaults to a raw_data.sqlite file next to the scripts. The store should be on a local disk, sqlite's locks don't work reliably
+# in a folder that's synced (Teams, OneDrive...) and a sync can make conflict copies of it. The raw excels are what's shared
+RAW_DATA_STORE_PATH = os.environ.get("RAW_DATA_STORE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "raw_data.sqlite")
+
+def copy_shared_store():
+    """
+    The store used to default to raw_data.sqlite next to the raw excels on the shared drive, the first time the local store is used
+    that one is copied so its ledger, history and watermarks are kept
+    """
+    shared_path = os.path.join(os.path.dirname(EXCEL_PATHS[ENROLLMENTS] or ""), "raw_data.sqlite")
+    if os.path.exists(RAW_DATA_STORE_PATH) or not os.path.isfile(shared_path) or os.path.abspath(shared_path) == os.path.abspath(RAW_DATA_STORE_PATH):
+        return
+
+    # The backup api copies a consistent store even if the file has a journal next to it
+    with closing(sqlite3.connect(shared_path)) as source, closing(sqlite3.connect(RAW_DATA_STORE_PATH)) as target:
+        source.backup(target)
+    print(f"COPIED THE RAW DATA STORE FROM {shared_path} TO {RAW_DATA_STORE_PATH}, THE SHARED COPY ISN'T USED ANYMORE")
+
+def connect(path=None):
+    """ Open the store and create the tables if they don't exist yet """
+    if path is None:
+        copy_shared_store()
+    connection = sqlite3.connect(path or RAW_DATA_STORE_PATH)
+    for table in EXCEL_PATHS:
+        connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                row_hash TEXT NOT NULL UNIQUE,
+                inserted_at TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WATERMARKS} (
+            table_name TEXT PRIMARY KEY,
+            filters TEXT NOT NULL,
+            synced_at TEXT NOT NULL,
+            full_synced_at TEXT
+        )
+    """)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LOOKUPS} (
+            table_name TEXT NOT NULL,
+            lookup_key TEXT NOT NULL,
+            looked_up_at TEXT NOT NULL,
+            PRIMARY KEY (table_name, lookup_key)
+        )
+    """)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DISTRIBUTED} (
+            user_key TEXT NOT NULL,
+            program TEXT NOT NULL,
+            session TEXT NOT NULL,
+            listing_id TEXT NOT NULL,
+            data_hash TEXT NOT NULL,
+            excel TEXT NOT NULL,
+            run_id TEXT NOT NULL,
+            distributed_at TEXT NOT NULL,
+            PRIMARY KEY (user_key, program, session, listing_id)
+        )
+    """)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DISTRIBUTION_HISTORY} (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {DISTRIBUTION_HISTORY}_run_id ON {DISTRIBUTION_HISTORY} (run_id)")
+    connection.commit()
+
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    if version < HASH_VERSION:
+        rehash_rows(connection)
+        connection.execute(f"PRAGMA user_version = {HASH_VERSION}")
+        connection.commit()
+    return connection
+
+def rehash_rows(connection):
+    """ Recompute the hash of every stored row after row_hash changed, rows that now have the same hash as an earlier row are deleted """
+    for table in EXCEL_PATHS:
+        seen = set()
+        duplicates = []
+        changed = []
+        for (row_id, old_hash, data) in connection.execute(f"SELECT id, row_hash, data FROM {table} ORDER BY id"):
+            new_hash = row_hash(json.loads(data))
+            if new_hash in seen:
+                duplicates.append((row_id,))
+                continue
+            seen.add(new_hash)
+            if new_hash != old_hash:
+                changed.append((new_hash, row_id))
+
+        connection.executemany(f"DELETE FROM {table} WHERE id = ?", duplicates)
+        connection.executemany(f"UPDATE {table} SET row_hash = ? WHERE id = ?", changed)
+        if duplicates or changed:
+            print(f"REHASHED {len(changed)} ROWS OF {table} IN THE RAW DATA STORE, {len(duplicates)} DUPLICATES REMOVED")
+
+def normalize_value(value):
+    """ Empty cells become None and whole floats become ints, so the same value read back from an excel hashes the same """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def frame_to_records(df):
+    """ Turn the DataFrame into plain JSON-able dicts, leaving out empty values """
+    records = json.loads(df.to_json(orient='records', date_format='iso'))
+    return [{column: normalize_value(value) for column, value in record.items() if normalize_value(value) is not None} for record in records]
+
+def hash_text(value):
+    """ The text a value is hashed as: text that reads as a number is hashed as that number, so "250.00", 250.0 and 250 are the same """
+    if isinstance(value, str) and '_' not in value:
+        for number_type in (int, float):
+            try:
+                number = number_type(value)
+            except ValueError:
+                continue
+            if math.isfinite(number):
+                value = normalize_value(number)
+            break
+    return str(value)
+
+def row_hash(record):
+    """
+    Hash every column and value of a row, same idea as drop_duplicates comparing every column.
+    Values are compared as text through hash_text, so a row hashes the same however its columns were typed (columns schema.py doesn't
+    declare are only numbers if every value of the batch is one).
+    """
+    text = json.dumps({column: hash_text(value) for column, value in record.items()}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def insert_records(connection, table, records):
+    """ Insert the rows that aren't in the table yet, keeping the existing copy of duplicates. Returns the new records """
+    inserted_at = datetime.now().isoformat(timespec='seconds')
+    new_records = []
+    for record in records:
+        cursor = connection.execute(
+            f"INSERT OR IGNORE INTO {table} (row_hash, inserted_at, data) VALUES (?, ?, ?)",
+            (row_hash(record), inserted_at, json.dumps(record, ensure_ascii=False))
+        )
+        if cursor.rowcount > 0:
+            new_records.append(record)
+    connection.commit()
+    return new_records
+
+def import_excel_if_empty(connection, table):
+    """ The first time a table is used, bring in the rows from the excel it replaces so no history is lost """
+    filename = EXCEL_PATHS[table]
+    (count,) = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+    if count > 0 or not filename or not os.path.isfile(filename):
+        return
+
+    try:
+        df_old = pd.read_excel(filename)
+    except Exception as e:
+        print(f"Error reading the Excel file: {e}")
+        return
+
+    new_records = insert_records(connection, table, frame_to_records(df_old))
+    print(f"IMPORTED {len(new_records)} ROWS FROM {filename} INTO THE RAW DATA STORE")
+
+def append_rows(table, df_new_data):
+    """ Append the rows of df_new_data that aren't already in the store, returns how many rows were new """
+    with closing(connect()) as connection:
+        import_excel_if_empty(connection, table)
+        new_records = insert_records(connection, table, frame_to_records(df_new_data))
+    return len(new_records)
+
+def stored_hashes(connection, table, hashes):
+    """ The hashes that are already in the table, looked up in chunks to stay under sqlite's limit on query parameters """
+    hashes = list(hashes)
+    found = set()
+    for start in range(0, len(hashes), 500):
+        chunk = hashes[start:start + 500]
+        query = f"SELECT row_hash FROM {table} WHERE row_hash IN ({','.join('?' * len(chunk))})"
+        found.update(stored_hash for (stored_hash,) in connection.execute(query, chunk))
+    return found
+
+def all_rows_stored(table, df):
+    """ True if df has rows and every one of them is already in the store """
+    hashes = {row_hash(record) for record in frame_to_records(df)}
+    if len(hashes) == 0:
+        return False
+
+    with closing(connect()) as connection:
+        import_excel_if_empty(connection, table)
+        return stored_hashes(connection, table, hashes) == hashes
+
+def read_watermark(table):
+    """
+    The filters the table was last scraped with and when, None if it was never scraped into the store.
+    Together with the row hashes this is how far the store is up to date, a new scrape with the same filters can stop once it only finds stored rows.
+    """
+    with closing(connect()) as connection:
+        row = connection.execute(f"SELECT filters, synced_at, full_synced_at FROM {WATERMARKS} WHERE table_name = ?", (table,)).fetchone()
+    if row is None:
+        return None
+    (filters, synced_at, full_synced_at) = row
+    return {'filters': json.loads(filters), 'synced_at': synced_at, 'full_synced_at': full_synced_at}
+
+def save_watermark(table, filters, full):
+    """ Remember that the table is up to date for these filters, full is whether every page was scraped """
+    synced_at = datetime.now().isoformat(timespec='seconds')
+    with closing(connect()) as connection:
+        previous = connection.execute(f"SELECT filters, full_synced_at FROM {WATERMARKS} WHERE table_name = ?", (table,)).fetchone()
+        # A full resync with other filters doesn't cover the old ones, so only keep the old full sync time when the filters match
+        full_synced_at = synced_at if full else (previous[1] if previous and json.loads(previous[0]) == filters else None)
+        connection.execute(
+            f"INSERT OR REPLACE INTO {WATERMARKS} (table_name, filters, synced_at, full_synced_at) VALUES (?, ?, ?, ?)",
+            (table, json.dumps(filters, sort_keys=True), synced_at, full_synced_at)
+        )
+        connection.commit()
+
+def last_seen(table, column):
+    """
+    When each value of column was last stored or looked up, keyed on the lowercase value.
+    A row that is scraped again unchanged keeps its first inserted_at, save_lookups records that it was checked.
+    """
+    with closing(connect()) as connection:
+        import_excel_if_empty(connection, table)
+        stored = connection.execute(f"SELECT json_extract(data, ?), MAX(inserted_at) FROM {table} GROUP BY 1", (f'$."{column}"',)).fetchall()
+        looked_up = connection.execute(f"SELECT lookup_key, looked_up_at FROM {LOOKUPS} WHERE table_name = ?", (table,)).fetchall()
+
+    seen = {}
+    for (value, seen_at) in stored + looked_up:
+        if value is None:
+            continue
+        key = str(value).lower().strip()
+        seen[key] = max(seen.get(key, seen_at), seen_at)
+    return seen
+
+def save_lookups(table, keys):
+    """ Remember that the rows with these keys (lowercase values, like last_seen) were just looked up """
+    looked_up_at = datetime.now().isoformat(timespec='seconds')
+    with closing(connect()) as connection:
+        connection.executemany(
+            f"INSERT OR REPLACE INTO {LOOKUPS} (table_name, lookup_key, looked_up_at) VALUES (?, ?, ?)",
+            [(table, key, looked_up_at) for key in keys]
+        )
+        connection.commit()
+
+def read_ledger():
+    """ The key and data hash of every enrollment in the distribution ledger """
+    with closing(connect()) as connection:
+        return pd.read_sql_query(f"SELECT {', '.join(LEDGER_KEY)}, data_hash FROM {DISTRIBUTED}", connection)
+
+def save_distribution(run_id, df_ledger, rows):
+    """
+    Record a run's distributed enrollments: df_ledger has the LEDGER_KEY columns, data_hash and excel of each row, rows is the data
+    that was written. The ledger keeps the latest run for each enrollment and the rows are saved as the run's history.
+    """
+    distributed_at = datetime.now().isoformat(timespec='seconds')
+    with closing(connect()) as connection:
+        import_history_if_empty(connection)
+        connection.executemany(
+            f"INSERT OR REPLACE INTO {DISTRIBUTED} ({', '.join(LEDGER_KEY)}, data_hash, excel, run_id, distributed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*key, run_id, distributed_at) for key in df_ledger[LEDGER_KEY + ['data_hash', 'excel']].itertuples(index=False)]
+        )
+        connection.executemany(
+            f"INSERT INTO {DISTRIBUTION_HISTORY} (run_id, data) VALUES (?, ?)",
+            [(run_id, json.dumps(record, ensure_ascii=False)) for record in frame_to_records(pd.DataFrame(rows))]
+        )
+        connection.commit()
+
+def history_file_run_id(filename):
+    """ The date add_date_to_filename added to a history excel's name, which is the run id of its rows """
+    (name, _) = os.path.splitext(os.path.basename(filename))
+    return name[-len('YYYYmmdd_HHMMSS'):]
+
+def import_history_if_empty(connection):
+    """ The first time the history table is used, bring in the history excels of earlier runs as their own runs """
+    history_path = os.environ.get("ENROLLMENTS_HISTORY_PATH")
+    (count,) = connection.execute(f"SELECT COUNT(*) FROM {DISTRIBUTION_HISTORY}").fetchone()
+    if count > 0 or not history_path:
+        return
+
+    (name, extension) = os.path.splitext(history_path)
+    for filename in sorted(glob.glob(f"{glob.escape(name)}_*{extension}")):
+        try:
+            df_old = pd.read_excel(filename)
+        except Exception as e:
+            print(f"Error reading the Excel file: {e}")
+            continue
+        run_id = history_file_run_id(filename)
+        connection.executemany(
+            f"INSERT INTO {DISTRIBUTION_HISTORY} (run_id, data) VALUES (?, ?)",
+            [(run_id, json.dumps(record, ensure_ascii=False)) for record in frame_to_records(df_old)]
+        )
+        print(f"IMPORTED {len(df_old)} ROWS FROM {filename} INTO THE DISTRIBUTION HISTORY")
+    connection.commit()
+
+def history_runs():
+    """ The id (start date) and row count of every run in the distribution history, oldest first """
+    with closing(connect()) as connection:
+        import_history_if_empty(connection)
+        return connection.execute(f"SELECT run_id, COUNT(*) FROM {DISTRIBUTION_HISTORY} GROUP BY run_id ORDER BY run_id").fetchall()
+
+def read_history(run_id=None):
+    """ The rows a run distributed, the latest run if run_id isn't set """
+    with closing(connect()) as connection:
+        import_history_if_empty(connection)
+        if run_id is None:
+            (run_id,) = connection.execute(f"SELECT MAX(run_id) FROM {DISTRIBUTION_HISTORY}").fetchone()
+        rows = connection.execute(f"SELECT data FROM {DISTRIBUTION_HISTORY} WHERE run_id = ? ORDER BY id", (run_id,)).fetchall()
+    return pd.DataFrame([json.loads(data) for (data,) in rows])
+
+def export_history(run_id=None, filename=None):
+    """ Write a run's rows to an excel, by default the history excel the run used to save (enrollments_<run id>.xlsx in 0EnrollmentHistory) """
+    if run_id is None:
+        runs = history_runs()
+        if len(runs) == 0:
+            print("NO DISTRIBUTION HISTORY TO EXPORT")
+            return
+        run_id = runs[-1][0]
+    (name, extension) = os.path.splitext(os.environ.get("ENROLLMENTS_HISTORY_PATH") or "enrollments.xlsx")
+    filename = filename or f"{name}_{run_id}{extension}"
+    read_history(run_id).to_excel(filename, index=False)
+    print(f"EXPORTED THE DISTRIBUTION HISTORY OF RUN {run_id} TO {filename}")
+
+def read_table(table, columns=None):
+    """ Read every row of the table in the order they were first scraped, only the given columns if columns is set """
+    with closing(connect()) as connection:
+        import_excel_if_empty(connection, table)
+        if columns is None:
+            rows = connection.execute(f"SELECT data FROM {table} ORDER BY id").fetchall()
+            df = pd.DataFrame([json.loads(data) for (data,) in rows])
+        else:
+            # sqlite pulls the columns out of the JSON so the rest of each row is never parsed
+            selected = ", ".join("json_extract(data, ?)" for _ in columns)
+            rows = connection.execute(f"SELECT {selected} FROM {table} ORDER BY id", [f'$."{column}"' for column in columns]).fetchall()
+            df = pd.DataFrame(rows, columns=columns)
+    return schema.apply_schema(df, table)
+
+def export_to_excel(table, filename=None):
+    """ Write the whole table out to an excel, by default the one in 0RawData it replaced """
+    filename = filename or EXCEL_PATHS[table]
+    read_table(table).to_excel(filename, index=False)
+    print(f"EXPORTED {table} TO {filename}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the raw data store to the excels in 0RawData')
+    parser.add_argument('--tables', nargs='+', choices=list(EXCEL_PATHS), default=list(EXCEL_PATHS), help='Tables to export. Example: --tables users. Defaults to all tables')
+    parser.add_argument('--history', nargs='?', const='latest', help='Export the rows one distribution run wrote instead, to enrollments_<run id>.xlsx in 0EnrollmentHistory. Example: --history 20240105_093000. Defaults to the latest run')
+    parser.add_argument('--list-runs', action='store_true', help='Print the id and row count of every run in the distribution history')
+    args = parser.parse_args()
+
+    if args.list_runs:
+        for (run_id, count) in history_runs():
+            print(run_id, count)
+    elif args.history is not None:
+        export_history(None if args.history == 'latest' else args.history)
+    else:
+        for table in args.tables:
+            export_to_excel(table)
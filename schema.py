@@ -0,0 +1,48 @@
+import pandas as pd
+
+"""
+Declared column types of the scraped tables, keyed by raw_store table name and column (the data-testid, split into _0 and _1 where the
+parser splits it). The repeated program and account strings are categoricals and listing ids are nullable integers.
+Every type here writes the same text to the raw data store as the old try every column with pd.to_numeric conversion did, so row hashes
+of rows stored before still match. Columns that aren't declared still get that conversion, which depends on the rest of the batch,
+raw_store.row_hash hashes text that reads as a number as the number so it doesn't change which rows are stored.
+"""
+
+TABLE_SCHEMAS = {
+    "enrollments": {
+        'student_name_0': 'string',
+        'student_name_1': 'string',
+        'account_name': 'category',
+        'product_name_0': 'category',
+        'product_name_1': 'Int64',
+        'enrollment_state': 'category',
+    },
+    "users": {
+        'student_name_0': 'string',
+        'student_name_1': 'string',
+        'custom_fields_organization': 'string',
+        'custom_fields_title': 'string',
+        'custom_fields_mailing-address': 'string',
+    },
+}
+
+def numeric_if_possible(series):
+    """ The column as numbers if every value is one, otherwise unchanged """
+    try:
+        return pd.to_numeric(series, errors='raise')
+    except (ValueError, TypeError):
+        return series
+
+def apply_schema(df, table):
+    """ Give the columns of a scraped or stored table their declared types in one pass, used at extraction and when the table is read back """
+    schema = TABLE_SCHEMAS[table]
+    integer_columns = [column for column in df.columns if schema.get(column) == 'Int64']
+    declared = {column: schema[column] for column in df.columns if column in schema and column not in integer_columns}
+
+    df = df.astype(declared)
+    for column in integer_columns:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+    for column in df.columns:
+        if column not in schema:
+            df[column] = numeric_if_possible(df[column])
+    return df
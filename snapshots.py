@@ -0,0 +1,47 @@
+import os
+import json
+import gzip
+from glob import glob
+
+"""
+Snapshots of the scraped table pages so a run can be replayed without a browser.
+get_data.py --record DIR saves every enrollments/users page payload (the script cells or the page html) and the filter arguments,
+get_data.py --replay DIR feeds them back through extraction, the raw data store and distribution.
+Each snapshot is one gzip compressed JSON file named <table>_<page number>.json.gz so they sort in scrape order.
+"""
+
+FILTERS_FILE = "filters.json.gz"
+
+def write_json(path, data):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+def read_json(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_filters(directory, filters):
+    """ Save the arguments the run was filtered with, so a replay shows what the snapshots contain """
+    os.makedirs(directory, exist_ok=True)
+    write_json(os.path.join(directory, FILTERS_FILE), filters)
+
+def load_filters(directory):
+    path = os.path.join(directory, FILTERS_FILE)
+    return read_json(path) if os.path.isfile(path) else {}
+
+def save_page(directory, table, page_number, extract_mode, payload):
+    """ Save one page of the table, payload is whatever the extract mode read from the browser """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}_{page_number:05d}.json.gz")
+    write_json(path, {'table': table, 'page': page_number, 'extract_mode': extract_mode, 'payload': payload})
+
+def load_pages(directory, table):
+    """ Yields (extract_mode, payload) for every saved page of the table, in the order they were scraped """
+    paths = sorted(glob(os.path.join(directory, f"{table}_*.json.gz")))
+    if len(paths) == 0:
+        print(f"NO SNAPSHOTS OF {table} FOUND IN {directory}")
+
+    for path in paths:
+        snapshot = read_json(path)
+        print(f"REPLAYING {table} PAGE {snapshot['page']}")
+        yield (snapshot['extract_mode'], snapshot['payload'])
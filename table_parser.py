@@ -0,0 +1,223 @@
+import re
+import json
+import argparse
+import pandas as pd
+
+"""
+Parses the Canvas Catalog analytics table into rows without needing a browser, so saved pages can be parsed and benchmarked offline.
+Each row is a dict keyed by the cell's data-testid (student_name and product_name are split into _0 and _1 columns).
+
+Every backend first turns the table into cells of (data-testid, text, aria-labels of its spans, text of its first screenReaderContent span),
+the same cells get_data.EXTRACT_TABLE_SCRIPT collects in the browser, then parse_cell applies the column rules.
+lxml and selectolax are optional and much faster on large pages, BeautifulSoup is always available as a fallback.
+"""
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+from bs4 import BeautifulSoup
+
+NAME_REGEX = '(^[0-9A-Za-z\\u0100-\\u017FÀ-ÖØ-öø-ÿ\\s\\-\\(\\)\'\\.]+)'
+EMAIL_REGEX = '([A-z0-9\\.\\#\\-\\_\\|]+@[A-z0-9\\.\\-]{4,})'
+
+# Compiled once here instead of for every cell
+FULL_PATTERN = re.compile(f'{NAME_REGEX}(#[0-9]+)(\\s\\|\\s)?{EMAIL_REGEX}?')
+NAME_PATTERN = re.compile(NAME_REGEX, re.I)
+EMAIL_PATTERN = re.compile(EMAIL_REGEX, re.I)
+ID_PATTERN = re.compile('[0-9]{4,}$')
+SCREEN_READER_PATTERN = re.compile("screenReaderContent", re.IGNORECASE)
+
+# Only these columns use the aria-labels and screen reader text, the backends skip looking them up for the other cells
+SPLIT_LABELS = ('student_name', 'product_name')
+
+def parse_cell(label, text, aria_labels, screen_reader_text, row_data):
+    """ Split one cell into its columns, label is the data-testid which is used as the column header """
+    if label == 'student_name':
+        full_match = FULL_PATTERN.search(text)
+
+        if full_match:
+            name_found = False
+            email_found = False
+
+            # if <span> with aria-label exists, get name and/or email from that
+            for aria_label in aria_labels:
+                name_match = NAME_PATTERN.search(aria_label)
+                email_match = EMAIL_PATTERN.search(aria_label)
+                if name_match:
+                    row_data[f'{label}_0'] = name_match.group(1)
+                    name_found = True
+                if email_match:
+                    row_data[f'{label}_1'] = email_match.string
+                    email_found = True
+
+            # check if the full name and/or email were found in a span's aria-label property
+            # if not, get from innerText match
+            if name_found is False:
+                row_data[f'{label}_0'] = full_match.group(1)
+            if email_found is False:
+                if(len(full_match.groups()) > 1):
+                    row_data[f'{label}_1'] = ''.join(map(str, full_match.groups()[1:]))
+                else:
+                    row_data[f'{label}_1'] = '—'
+        # if no regex match for td innerText, insert full innerText into first column
+        else:
+            row_data[f'{label}_0'] = text
+    elif label == 'product_name':
+        # if truncated text, get full listing name from aria-label and id from innerText
+        if len(aria_labels) > 0:
+            row_data[f'{label}_0'] = aria_labels[0]
+            row_data[f'{label}_1'] = ID_PATTERN.search(text).group(0)
+
+        # if no truncated text, get listing name and id from innerText
+        else:
+            match = ID_PATTERN.search(text)
+
+            if match:
+                listing_id = match.group(0)
+
+                # only listing names that overflow the cell contain a <span> element with the ...-screenReaderContent class
+                if screen_reader_text is not None:
+                    listing_name = screen_reader_text
+                else:
+                    listing_name = text.replace(listing_id, "")
+
+                row_data[f'{label}_0'] = listing_name
+                row_data[f'{label}_1'] = listing_id
+            else:
+                row_data[f'{label}_0'] = text
+
+    else:
+        row_data[label] = text
+
+def rows_from_cells(cell_rows):
+    """ Apply the column rules to every row of cells """
+    rows = []
+    for cells in cell_rows:
+        row_data = {}
+        for (label, text, aria_labels, screen_reader_text) in cells:
+            parse_cell(label, text, aria_labels, screen_reader_text, row_data)
+        rows.append(row_data)
+    return rows
+
+def bs4_table_cells(html):
+    """ Cells of the first table's tbody using BeautifulSoup's html.parser """
+    soup = BeautifulSoup(html, 'html.parser')
+
+    tbody = soup.find('table').find('tbody')
+    cell_rows = []
+    for row in tbody.find_all('tr'):
+        cells = []
+        for td in row.find_all(['td', 'th']):
+            # getting the column's label from data-testid attribute
+            if 'data-testid' in td.attrs:
+                label = td['data-testid']
+                aria_labels = []
+                screen_reader_text = None
+
+                if label in SPLIT_LABELS:
+                    aria_labels = [span['aria-label'] for span in td.find_all('span') if span.has_attr('aria-label')]
+                    screen_reader_span = td.find('span', class_=SCREEN_READER_PATTERN)
+                    if screen_reader_span is not None:
+                        screen_reader_text = screen_reader_span.text
+
+                cells.append((label, td.text, aria_labels, screen_reader_text))
+        cell_rows.append(cells)
+    return cell_rows
+
+def lxml_table_cells(html):
+    """ Cells of the first table's tbody using lxml """
+    root = lxml.html.fromstring(html)
+
+    table = next(root.iter('table'))
+    tbody = next(table.iter('tbody'))
+    cell_rows = []
+    for row in tbody.iter('tr'):
+        cells = []
+        for td in row.iter('td', 'th'):
+            label = td.get('data-testid')
+            if label is not None:
+                aria_labels = []
+                screen_reader_text = None
+
+                if label in SPLIT_LABELS:
+                    spans = list(td.iter('span'))
+                    aria_labels = [span.get('aria-label') for span in spans if span.get('aria-label') is not None]
+                    screen_reader_text = next((span.text_content() for span in spans if SCREEN_READER_PATTERN.search(span.get('class', ''))), None)
+
+                cells.append((label, td.text_content(), aria_labels, screen_reader_text))
+        cell_rows.append(cells)
+    return cell_rows
+
+def selectolax_table_cells(html):
+    """ Cells of the first table's tbody using selectolax """
+    tree = LexborHTMLParser(html)
+
+    tbody = tree.css_first('table').css_first('tbody')
+    cell_rows = []
+    for row in tbody.css('tr'):
+        cells = []
+        for td in row.traverse():
+            if td.tag not in ('td', 'th') or 'data-testid' not in td.attributes:
+                continue
+
+            label = td.attributes['data-testid'] or ''
+            aria_labels = []
+            screen_reader_text = None
+
+            if label in SPLIT_LABELS:
+                spans = td.css('span')
+                aria_labels = [span.attributes['aria-label'] or '' for span in spans if 'aria-label' in span.attributes]
+                screen_reader_text = next((span.text(deep=True) for span in spans if SCREEN_READER_PATTERN.search(span.attributes.get('class') or '')), None)
+
+            cells.append((label, td.text(deep=True), aria_labels, screen_reader_text))
+        cell_rows.append(cells)
+    return cell_rows
+
+# Fastest first, the first one that's installed is the default
+BACKENDS = {
+    'lxml': lxml_table_cells if lxml is not None else None,
+    'selectolax': selectolax_table_cells if LexborHTMLParser is not None else None,
+    'bs4': bs4_table_cells,
+}
+DEFAULT_BACKEND = next(name for name, table_cells in BACKENDS.items() if table_cells is not None)
+
+def parse_table_html(html, backend=None):
+    """ Parse the analytics table in the page html into rows, backend is one of BACKENDS, defaults to the fastest installed """
+    table_cells = BACKENDS[backend or DEFAULT_BACKEND]
+    if table_cells is None:
+        raise ImportError(f"The {backend} html parser is not installed, use one of {[name for name, cells in BACKENDS.items() if cells is not None]}")
+    return rows_from_cells(table_cells(html))
+
+def parse_pages(pages, backend=None):
+    """ Parse a list of page snapshots (html) into one list of rows, in page order """
+    rows = []
+    for html in pages:
+        rows.extend(parse_table_html(html, backend))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse saved Canvas Catalog analytics pages into rows without a browser')
+    parser.add_argument('pages', nargs='+', help='Saved html pages, parsed in the order given')
+    parser.add_argument('--backend', choices=list(BACKENDS), default=DEFAULT_BACKEND, help=f'html parser to use. Defaults to {DEFAULT_BACKEND}')
+    parser.add_argument('--output', help='Save the rows to this excel instead of printing them')
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.pages:
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+
+    rows = parse_pages(pages, args.backend)
+    if args.output:
+        pd.DataFrame(rows).to_excel(args.output, index=False)
+        print(f"SAVED {len(rows)} ROWS TO {args.output}")
+    else:
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
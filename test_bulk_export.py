@@ -0,0 +1,131 @@
+import json
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+
+import bulk_export
+import raw_store
+
+"""
+bulk_export against a local stand-in for the analytics export endpoint, serving recorded responses.
+Run with python -m unittest test_bulk_export
+"""
+
+def enrollment(i, course="CVA", status="active"):
+    return {'student_name': f"Student {i} | student{i}@x.com", 'account_name': f"{course} - Online", 'product_name': f"{course} Program 2024 Spring {1000 + i}", 'enrollment_state': status}
+
+# Recorded export rows, every 4th one is another course and every 5th one is dropped
+ROWS = [enrollment(i, "CNR" if i % 4 == 0 else "CVA", "dropped" if i % 5 == 0 else "active") for i in range(250)]
+
+class ExportHandler(BaseHTTPRequestHandler):
+    # Set by each test: (query params, handler) -> (status, headers, body)
+    respond = None
+
+    def do_GET(self):
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        self.server.requests.append({'params': params, 'cookie': self.headers.get('Cookie')})
+        (status, headers, body) = type(self).respond(params, self)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+def paged(params, per_page_cap=None):
+    """ The page of ROWS the params ask for, with per_page capped like Canvas does """
+    per_page = int(params['per_page'])
+    if per_page_cap:
+        per_page = min(per_page, per_page_cap)
+    page = int(params['page'])
+    return ROWS[(page - 1) * per_page:page * per_page]
+
+class FakeDriver:
+    def get_cookies(self):
+        return [{'name': 'session', 'value': 'abc', 'domain': '127.0.0.1', 'path': '/'}]
+
+    def execute_script(self, script):
+        return "test-agent"
+
+class BulkExportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ExportHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/export"
+        patcher = mock.patch.dict(bulk_export.EXPORT_URLS, {raw_store.ENROLLMENTS: self.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve(self, respond):
+        ExportHandler.respond = staticmethod(respond)
+
+    def export(self, filters=None, session=None):
+        pages = bulk_export.export_pages(session or requests.Session(), raw_store.ENROLLMENTS, filters)
+        return [{label: text for label, text, _, _ in row} for (_, cells) in pages for row in cells]
+
+    def test_total_pages_from_link_header(self):
+        link = f'<{self.url}?page=3&per_page=100>; rel="last"'
+        self.serve(lambda params, handler: (200, {'Link': link}, paged(params, per_page_cap=100)))
+        self.assertEqual(len(self.export()), len(ROWS))
+        self.assertEqual(sorted(int(request['params']['page']) for request in self.server.requests), [1, 2, 3])
+
+    def test_total_pages_from_body(self):
+        self.serve(lambda params, handler: (200, {}, {'data': paged(params), 'meta': {'total_pages': 1}}))
+        self.assertEqual(len(self.export()), len(ROWS))
+
+    def test_capped_page_size_without_page_count(self):
+        # The server ignores per_page=1000 and sends 100 rows a page, the short third page is the last one
+        self.serve(lambda params, handler: (200, {}, {'rows': paged(params, per_page_cap=100)}))
+        rows = self.export()
+        self.assertEqual([row['student_name'] for row in rows], [row['student_name'] for row in ROWS])
+
+    def test_small_table_without_page_count(self):
+        self.serve(lambda params, handler: (200, {}, ROWS[:37] if params['page'] == '1' else []))
+        self.assertEqual(len(self.export()), 37)
+
+    def test_filters_are_applied_to_the_rows(self):
+        self.serve(lambda params, handler: (200, {}, {'results': paged(params), 'total_pages': 1}))
+        rows = self.export({'courses': ['CVA'], 'status': ['Active']})
+        expected = [row for row in ROWS if row['account_name'].startswith("CVA ") and row['enrollment_state'] == 'active']
+        self.assertEqual([row['student_name'] for row in rows], [row['student_name'] for row in expected])
+
+    def test_rows_without_a_filtered_column_fail(self):
+        rows = [{key: value for key, value in row.items() if key != 'enrollment_state'} for row in ROWS[:10]]
+        self.serve(lambda params, handler: (200, {}, rows if params['page'] == '1' else []))
+        with self.assertRaises(bulk_export.BulkExportError):
+            self.export({'courses': ['CVA'], 'status': ['Active']})
+
+    def test_server_error_fails(self):
+        self.serve(lambda params, handler: (403, {}, {'error': 'not logged in'}))
+        with self.assertRaises(bulk_export.BulkExportError):
+            self.export()
+
+    def test_unexpected_response_fails(self):
+        self.serve(lambda params, handler: (200, {}, {'enrollments': ROWS}))
+        with self.assertRaises(bulk_export.BulkExportError):
+            self.export()
+
+    def test_ignored_page_parameter_fails(self):
+        self.serve(lambda params, handler: (200, {}, ROWS[:5]))
+        with self.assertRaises(bulk_export.BulkExportError):
+            self.export()
+
+    def test_session_from_driver_sends_the_cookies(self):
+        self.serve(lambda params, handler: (200, {}, ROWS[:5] if params['page'] == '1' else []))
+        self.export(session=bulk_export.session_from_driver(FakeDriver()))
+        self.assertEqual(self.server.requests[0]['cookie'], 'session=abc')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font
+from openpyxl.worksheet.table import Table
+
+import distribute
+import xlsx_fast
+
+"""
+xlsx_fast against openpyxl: the same rows are written to copies of a registration excel by the fast path and by openpyxl,
+and both files have to read back the same. Run with python -m unittest test_xlsx_fast
+"""
+
+SHEET = "Spring 2024"
+SHEET_PART = "xl/worksheets/sheet1.xml"
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+SHARED_STRINGS_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"
+SHARED_STRINGS_RELATIONSHIP = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"
+
+# (email, data) written with insert_or_append_row, ann@x.com fills the styled empty cell of her row, the others are appended
+ENTRIES = [
+    ("ann@x.com", {'Full Name': "Ann A", 'Email Address': "ann@x.com", 'Organization': "Forestry Co", 'Price': 300}),
+    ("cam@x.com", {'Full Name': "Cam C", 'Email Address': "cam@x.com", 'Organization': " Leading space", 'Price': 99.5}),
+    ("dee@x.com", {'Full Name': "Dee & D <co>", 'Email Address': "dee@x.com", 'Organization': None, 'Price': 1200}),
+]
+
+def build_excel(path):
+    """ A registration excel like the real ones: a title, the header on row 2, a table over the rows and another sheet """
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = SHEET
+    sheet['A1'] = "Registrations"
+    sheet.append(["Full Name", "Email Address", "Organization", "Price"])
+    sheet.append(["Ann A", "ann@x.com", None, 250])
+    sheet.append(["Bob B", "bob@x.com", "UBC", 1200.5])
+    sheet['C3'].font = Font(bold=True)
+    sheet.add_table(Table(displayName="Registrations", ref="A2:D4"))
+    workbook.create_sheet("Fall 2024").append(["Not", "edited"])
+    workbook.save(path)
+    save_like_excel(path)
+
+def rewrite_parts(path, transforms, new_parts=None):
+    """ Replace parts of the xlsx zip with transforms[part](its text) and add new_parts ({part: text}) """
+    with zipfile.ZipFile(path) as archive:
+        parts = [(info, archive.read(info.filename)) for info in archive.infolist()]
+    with zipfile.ZipFile(path, 'w') as archive:
+        for info, data in parts:
+            transform = transforms.get(info.filename)
+            archive.writestr(info, transform(data.decode('utf-8')).encode('utf-8') if transform else data)
+        for part, text in (new_parts or {}).items():
+            archive.writestr(part, text.encode('utf-8'))
+
+def rewrite_part(path, part, transform):
+    rewrite_parts(path, {part: transform})
+
+def save_like_excel(path):
+    """
+    openpyxl writes text as inline strings and empty styled cells as <c></c>, Excel writes shared strings and <c/>.
+    The sheet's text is moved to xl/sharedStrings.xml, Bob B as rich text split into runs.
+    """
+    strings = []
+    def shared(match):
+        strings.append(match.group(2))
+        return f'<c r="{match.group(1)}" t="s"><v>{len(strings) - 1}</v></c>'
+    def sheet(xml):
+        xml = re.sub(r'<c r="(\w+)" t="inlineStr"><is><t>(.*?)</t></is></c>', shared, xml)
+        return re.sub(r'<c ([^>]*?)(?: t="n")?></c>', r'<c \1/>', xml)
+    # The sheet has to be rewritten first to know the strings
+    rewrite_part(path, SHEET_PART, sheet)
+
+    items = ["<si><r><t>Bo</t></r><r><rPr><b/></rPr><t>b B</t></r></si>" if text == "Bob B" else f"<si><t>{text}</t></si>" for text in strings]
+    shared_strings = f'<sst xmlns="{MAIN_NS}" count="{len(items)}" uniqueCount="{len(items)}">{"".join(items)}</sst>'
+    rewrite_parts(path, {
+        "[Content_Types].xml": lambda xml: xml.replace("</Types>", f'<Override PartName="/xl/sharedStrings.xml" ContentType="{SHARED_STRINGS_TYPE}"/></Types>'),
+        "xl/_rels/workbook.xml.rels": lambda xml: xml.replace("</Relationships>", f'<Relationship Id="rIdStrings" Type="{SHARED_STRINGS_RELATIONSHIP}" Target="sharedStrings.xml"/></Relationships>'),
+    }, {"xl/sharedStrings.xml": shared_strings})
+
+def add_empty_row(xml):
+    """ A self-closing row after the data, like a row that only has a height """
+    return xml.replace('</sheetData>', '<row r="6" ht="30" customHeight="1"/></sheetData>')
+
+def prefix_namespace(xml):
+    """ The same sheet with its elements written as x:row, x:c... instead of the default namespace """
+    xml = xml.replace(f'xmlns="{MAIN_NS}"', f'xmlns:x="{MAIN_NS}"')
+    return re.sub(r'<(/?)([A-Za-z]\w*)(?=[\s/>])', r'<\1x:\2', xml)
+
+def write_entries(workbook):
+    sheet = workbook[SHEET]
+    index = distribute.SheetIndex.from_worksheet(sheet)
+    for email, data in ENTRIES:
+        distribute.insert_or_append_row(sheet, index, data, index.search_email(email))
+
+def read_back(path):
+    """ Every sheet's values and table refs as openpyxl reads them """
+    workbook = load_workbook(path)
+    return {sheet.title: (list(sheet.iter_rows(values_only=True)), {name: sheet.tables[name].ref for name in sheet.tables})
+            for sheet in workbook.worksheets}
+
+class XlsxFastTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, "registrations.xlsx")
+        build_excel(self.path)
+
+    def assert_same_as_openpyxl(self):
+        openpyxl_path = os.path.join(self.folder, "openpyxl.xlsx")
+        shutil.copy(self.path, openpyxl_path)
+
+        workbook = xlsx_fast.FastWorkbook(self.path, [SHEET])
+        write_entries(workbook)
+        workbook.save()
+
+        workbook = load_workbook(openpyxl_path)
+        write_entries(workbook)
+        workbook.save(openpyxl_path)
+
+        fast = read_back(self.path)
+        self.assertEqual(fast, read_back(openpyxl_path))
+        return fast
+
+    def test_same_as_openpyxl(self):
+        (rows, tables) = self.assert_same_as_openpyxl()[SHEET]
+        self.assertEqual(rows[2], ("Ann A", "ann@x.com", "Forestry Co", 250))
+        self.assertEqual(rows[5], ("Dee & D <co>", "dee@x.com", None, 1200))
+        self.assertEqual(tables, {"Registrations": "A2:D6"})
+
+    def test_self_closing_row(self):
+        rewrite_part(self.path, SHEET_PART, add_empty_row)
+        (rows, _) = self.assert_same_as_openpyxl()[SHEET]
+        self.assertEqual(rows[5][0], "Dee & D <co>")
+
+    def test_namespace_prefix(self):
+        rewrite_part(self.path, SHEET_PART, lambda xml: prefix_namespace(add_empty_row(xml)))
+        self.assert_same_as_openpyxl()
+
+    def test_other_parts_are_copied(self):
+        with zipfile.ZipFile(self.path) as archive:
+            before = {info.filename: archive.read(info.filename) for info in archive.infolist()}
+        workbook = xlsx_fast.FastWorkbook(self.path, [SHEET])
+        write_entries(workbook)
+        workbook.save()
+        with zipfile.ZipFile(self.path) as archive:
+            after = {info.filename: archive.read(info.filename) for info in archive.infolist()}
+        changed = {part for part in before if before[part] != after[part]}
+        self.assertEqual(changed, {SHEET_PART, "xl/tables/table1.xml"})
+
+    def test_date_cell_is_unsupported(self):
+        rewrite_part(self.path, SHEET_PART, lambda xml: re.sub(r'<c r="D3"[^>]*>.*?</c>', '<c r="D3" t="d"><v>2024-01-05T00:00:00</v></c>', xml))
+        with self.assertRaises(xlsx_fast.Unsupported):
+            xlsx_fast.FastWorkbook(self.path, [SHEET])
+
+    def test_cell_without_reference_is_unsupported(self):
+        rewrite_part(self.path, SHEET_PART, lambda xml: xml.replace('<c r="D3"', '<c', 1))
+        with self.assertRaises(xlsx_fast.Unsupported):
+            xlsx_fast.FastWorkbook(self.path, [SHEET])
+
+if __name__ == '__main__':
+    unittest.main()
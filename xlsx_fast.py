@@ -0,0 +1,351 @@
+import os
+import re
+import math
+import numbers
+import shutil
+import zipfile
+import tempfile
+import posixpath
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+"""
+Fast write path for the registration excels that edits the worksheet XML inside the xlsx zip instead of loading the whole workbook with openpyxl.
+Only the sheets that get written to are read, rows are appended or patched as text in their <sheetData> and every other part of the file
+(other sheets, styles, shared strings, pivot tables, macros...) is copied through unchanged.
+
+FastWorkbook, FastSheet and FastCell have just enough of the openpyxl interface for SheetIndex.from_worksheet and insert_or_append_row:
+workbook[sheet name], sheet.iter_rows(values_only=True), sheet.cell(row, column).value and sheet.tables[name].ref.
+New text is written as inline strings so the shared strings never change. Anything the fast path can't edit safely raises Unsupported
+before anything is saved, so the caller can do the whole excel again with openpyxl.
+"""
+
+RELATIONSHIP_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+# Characters openpyxl refuses to write to a cell, the fast path falls back instead of writing them
+ILLEGAL_CHARACTERS = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+CELL_REFERENCE = re.compile(r'^([A-Z]+)([0-9]+)$')
+ATTRIBUTE = re.compile(r'([\w:.-]+)\s*=\s*(["\'])(.*?)\2', re.S)
+
+class Unsupported(Exception):
+    """ The workbook or the values can't be written safely by the fast path, use openpyxl instead """
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index
+
+def column_letters(index):
+    letters = ""
+    while index > 0:
+        (index, remainder) = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def value_supported(value):
+    """ Values the fast path writes the same way openpyxl would, strings starting with = would become formulas in openpyxl """
+    if value is None or isinstance(value, bool):
+        return True
+    if isinstance(value, numbers.Real):
+        return math.isfinite(value)
+    return isinstance(value, str) and not value.startswith('=') and not ILLEGAL_CHARACTERS.search(value)
+
+def values_supported(values):
+    return all(value_supported(value) for value in values)
+
+def attributes(start_tag):
+    return {name: value for (name, _, value) in ATTRIBUTE.findall(start_tag)}
+
+def start_tag(name, attrs, self_closing=False):
+    text = "".join(f' {key}="{value}"' for key, value in attrs.items())
+    return f"<{name}{text}{'/>' if self_closing else '>'}"
+
+def resolve_target(base_part, target):
+    """ Path of a relationship target inside the zip, relative to the part that has the relationship """
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base_part), target))
+
+def rels_path(part):
+    return posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+
+def read_relationships(archive, part):
+    """ {relationship id: zip path of the target} for the part, empty if it has none """
+    path = rels_path(part)
+    if path not in archive.namelist():
+        return {}
+    root = ET.fromstring(archive.read(path))
+    return {rel.get('Id'): resolve_target(part, rel.get('Target')) for rel in root if rel.get('TargetMode') != 'External'}
+
+class FastTable:
+    """ An excel table of the sheet, only its ref can be changed """
+    def __init__(self, part, xml):
+        self.part = part
+        self.xml = xml
+        match = re.search(r'<(?:\w+:)?table\b[^>]*>', xml)
+        if match is None or 'ref' not in attributes(match.group(0)):
+            raise Unsupported(f"Couldn't read the table in {part}")
+        self._ref = attributes(match.group(0))['ref']
+        self.changed = False
+
+    @property
+    def ref(self):
+        return self._ref
+
+    @ref.setter
+    def ref(self, value):
+        self._ref = value
+        self.changed = True
+
+    def to_xml(self):
+        """ The table XML with only the ref of the <table> element changed """
+        def replace_ref(match):
+            return re.sub(r'\bref\s*=\s*(["\']).*?\1', f'ref="{self._ref}"', match.group(0), count=1)
+        return re.sub(r'<(?:\w+:)?table\b[^>]*>', replace_ref, self.xml, count=1)
+
+class FastCell:
+    def __init__(self, sheet, row, column):
+        self.sheet = sheet
+        self.row = row
+        self.column = column
+
+    @property
+    def value(self):
+        return self.sheet.values.get((self.row, self.column))
+
+    @value.setter
+    def value(self, value):
+        if not value_supported(value):
+            # Checked for every value before the fast path is picked, so this is a bug and not a row to skip
+            raise ValueError(f"The fast xlsx writer can't write {value!r}")
+        if value is None:
+            # Only empty cells are written to, so there's nothing to change
+            return
+        self.sheet.values[(self.row, self.column)] = value
+        self.sheet.edits.setdefault(self.row, {})[self.column] = value
+
+class FastSheet:
+    def __init__(self, workbook, part):
+        self.workbook = workbook
+        self.part = part
+        self.xml = workbook.archive.read(part).decode('utf-8')
+        if re.search(r'<(\w+:)?sheetData\b', self.xml) is None:
+            raise Unsupported(f"Couldn't find the rows of {part}")
+        self.values = {}
+        self.edits = {}
+        self.max_row = 0
+        self.max_column = 0
+        self.read_values()
+
+        self.tables = {}
+        relationships = read_relationships(workbook.archive, part)
+        for table_part in re.findall(r'<(?:\w+:)?tablePart\b[^>]*>', self.xml):
+            table_path = relationships.get(attributes(table_part).get('r:id'))
+            if table_path is None:
+                raise Unsupported(f"Couldn't find a table of {part}")
+            table = FastTable(table_path, workbook.archive.read(table_path).decode('utf-8'))
+            name = re.search(r'\b(?:displayName|name)\s*=\s*(["\'])(.*?)\1', table.xml)
+            self.tables[name.group(2) if name else table_path] = table
+
+    def read_values(self):
+        """ Read every cell value the same way openpyxl reads it (formulas as =..., numbers as int or float) """
+        for element in ET.fromstring(self.xml).iter():
+            if local_name(element.tag) != 'c':
+                continue
+            reference = element.get('r')
+            match = CELL_REFERENCE.match(reference or '')
+            if match is None:
+                raise Unsupported(f"A cell in {self.part} has no reference")
+            (row, column) = (int(match.group(2)), column_index(match.group(1)))
+            self.max_row = max(self.max_row, row)
+            self.max_column = max(self.max_column, column)
+
+            children = {local_name(child.tag): child for child in element}
+            cell_type = element.get('t', 'n')
+            if cell_type == 'd':
+                raise Unsupported(f"Can't read the date cell {reference} of {self.part}")
+            try:
+                value = self.cell_value(children, cell_type)
+            except (ValueError, IndexError) as e:
+                raise Unsupported(f"Couldn't read the cell {reference} of {self.part}. Error message {e}") from e
+            if value is not None:
+                self.values[(row, column)] = value
+
+        # Rows can also exist without any cells
+        for row_tag in re.findall(r'<(?:\w+:)?row\b[^>]*>', self.xml):
+            row_reference = attributes(row_tag).get('r')
+            if row_reference is None or not row_reference.isdigit():
+                raise Unsupported(f"A row in {self.part} has no reference")
+            self.max_row = max(self.max_row, int(row_reference))
+
+    def cell_value(self, children, cell_type):
+        """ The value of a <c> element from its children, None if it's empty """
+        value = None
+        if 'f' in children and children['f'].text:
+            value = '=' + children['f'].text
+        elif cell_type == 'inlineStr' and 'is' in children:
+            value = "".join(text.text or '' for text in children['is'].iter() if local_name(text.tag) == 't')
+        elif 'v' in children and children['v'].text is not None:
+            text = children['v'].text
+            if cell_type == 's':
+                value = self.workbook.shared_strings()[int(text)]
+            elif cell_type == 'b':
+                value = text == '1'
+            elif cell_type in ('str', 'e'):
+                value = text
+            else:
+                number = float(text)
+                value = int(number) if number.is_integer() and re.fullmatch(r'-?[0-9]+', text) else number
+        return value
+
+    def iter_rows(self, values_only=True):
+        """ Like openpyxl's iter_rows(values_only=True), every row from 1 as a tuple of values up to the last used column """
+        for row in range(1, self.max_row + 1):
+            yield tuple(self.values.get((row, column)) for column in range(1, self.max_column + 1))
+
+    def cell(self, row, column):
+        return FastCell(self, row, column)
+
+    def cell_xml(self, prefix, reference, attrs, value):
+        attrs = {key: value for key, value in attrs.items() if key not in ('r', 't')}
+        attrs = {'r': reference, **attrs}
+        if isinstance(value, bool):
+            return start_tag(f"{prefix}c", {**attrs, 't': 'b'}) + f"<{prefix}v>{int(value)}</{prefix}v></{prefix}c>"
+        if isinstance(value, numbers.Real):
+            # Same formatting as openpyxl, so e.g. 2.0 is written as 2
+            return start_tag(f"{prefix}c", {**attrs, 't': 'n'}) + f"<{prefix}v>{'%.16g' % value}</{prefix}v></{prefix}c>"
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        return start_tag(f"{prefix}c", {**attrs, 't': 'inlineStr'}) + f"<{prefix}is><{prefix}t{space}>{escape(value)}</{prefix}t></{prefix}is></{prefix}c>"
+
+    def patch_row(self, prefix, row, row_xml, edits):
+        """ The row XML with the edited cells written, cells stay in column order """
+        if row_xml is None:
+            row_attrs = {'r': str(row)}
+            cells = []
+        else:
+            tag = re.match(rf'<{prefix}row\b[^>]*?/?>', row_xml).group(0)
+            # spans is only a hint for the columns the row uses and can be wrong after new cells, it's optional so drop it
+            row_attrs = {key: value for key, value in attributes(tag).items() if key != 'spans'}
+            cells = re.findall(rf'<{prefix}c\b[^>]*?(?:/>|>.*?</{prefix}c>)', row_xml, re.S)
+
+        by_column = {}
+        for cell in cells:
+            cell_attrs = attributes(re.match(rf'<{prefix}c\b[^>]*?/?>', cell).group(0))
+            by_column[column_index(CELL_REFERENCE.match(cell_attrs['r']).group(1))] = (cell, cell_attrs)
+
+        for column, value in edits.items():
+            (_, cell_attrs) = by_column.get(column, (None, {}))
+            by_column[column] = (self.cell_xml(prefix, f"{column_letters(column)}{row}", cell_attrs, value), None)
+
+        cells_xml = "".join(by_column[column][0] for column in sorted(by_column))
+        return start_tag(f"{prefix}row", row_attrs) + cells_xml + f"</{prefix}row>"
+
+    def to_xml(self):
+        """ The sheet XML with the edits written into <sheetData> and the dimension grown to cover them """
+        data_match = re.search(r'<(\w+:)?sheetData\b[^>]*?(/>|>(.*?)</\1?sheetData>)', self.xml, re.S)
+        if data_match is None:
+            raise Unsupported(f"Couldn't find the rows of {self.part}")
+        prefix = data_match.group(1) or ''
+        rows_xml = data_match.group(3) or ''
+
+        rows = [(int(attributes(re.match(rf'<{prefix}row\b[^>]*?/?>', row).group(0))['r']), row)
+                for row in re.findall(rf'<{prefix}row\b[^>]*?(?:/>|>.*?</{prefix}row>)', rows_xml, re.S)]
+        by_row = dict(rows)
+        for row, edits in self.edits.items():
+            by_row[row] = self.patch_row(prefix, row, by_row.get(row), edits)
+
+        sheet_data = f"<{prefix}sheetData>" + "".join(by_row[row] for row in sorted(by_row)) + f"</{prefix}sheetData>"
+        xml = self.xml[:data_match.start()] + sheet_data + self.xml[data_match.end():]
+
+        max_row = max([self.max_row] + list(self.edits))
+        max_column = max([self.max_column] + [column for edits in self.edits.values() for column in edits])
+        def grow_dimension(match):
+            start = match.group(2).split(':')[0]
+            return f'{match.group(1)}{start}:{column_letters(max_column)}{max_row}{match.group(3)}'
+        return re.sub(r'(<(?:\w+:)?dimension\b[^>]*?\bref\s*=\s*")([^"]*)(")', grow_dimension, xml, count=1)
+
+class FastWorkbook:
+    """ A registration excel opened for the fast write path, only sheetnames and the sheets used later are read """
+    def __init__(self, path, sheetnames=()):
+        self.path = path
+        self.archive = zipfile.ZipFile(path)
+        self.sheets = {}
+        self._shared_strings = None
+
+        names = self.archive.namelist()
+        if 'xl/workbook.xml' not in names:
+            raise Unsupported(f"{path} has no xl/workbook.xml")
+        relationships = read_relationships(self.archive, 'xl/workbook.xml')
+        root = ET.fromstring(self.archive.read('xl/workbook.xml'))
+        self.sheet_parts = {}
+        for sheet in root.iter():
+            if local_name(sheet.tag) == 'sheet':
+                part = relationships.get(sheet.get(f'{{{RELATIONSHIP_NS}}}id'))
+                if part is None or part not in names:
+                    raise Unsupported(f"Couldn't find the sheet {sheet.get('name')} in {path}")
+                self.sheet_parts[sheet.get('name')] = part
+
+        # Read the sheets that will be written now, so anything unsupported is found before the first row is written
+        for name in sheetnames:
+            if name in self.sheet_parts:
+                self[name]
+
+    @property
+    def sheetnames(self):
+        return list(self.sheet_parts)
+
+    def shared_strings(self):
+        if self._shared_strings is None:
+            self._shared_strings = []
+            if 'xl/sharedStrings.xml' in self.archive.namelist():
+                root = ET.fromstring(self.archive.read('xl/sharedStrings.xml'))
+                for item in root:
+                    # Rich text is split into runs, the text is every <t> except the phonetic ones
+                    texts = [text.text or '' for text in item.iter() if local_name(text.tag) == 't']
+                    phonetic = [text.text or '' for run in item if local_name(run.tag) == 'rPh' for text in run.iter() if local_name(text.tag) == 't']
+                    self._shared_strings.append("".join(texts[:len(texts) - len(phonetic)]))
+        return self._shared_strings
+
+    def __getitem__(self, name):
+        if name not in self.sheet_parts:
+            # Same message as openpyxl
+            raise KeyError(f"Worksheet {name} does not exist.")
+        if name not in self.sheets:
+            try:
+                self.sheets[name] = FastSheet(self, self.sheet_parts[name])
+            except (ET.ParseError, UnicodeDecodeError) as e:
+                raise Unsupported(f"Couldn't read the sheet {name}. Error message {e}") from e
+        return self.sheets[name]
+
+    def save(self, path=None):
+        """ Write a new copy of the zip with only the edited sheets and tables changed, then replace the excel with it """
+        path = path or self.path
+        changed = {}
+        for sheet in self.sheets.values():
+            if sheet.edits:
+                changed[sheet.part] = sheet.to_xml().encode('utf-8')
+            for table in sheet.tables.values():
+                if table.changed:
+                    changed[table.part] = table.to_xml().encode('utf-8')
+
+        if changed:
+            (handle, temp_path) = tempfile.mkstemp(suffix='.xlsx', dir=os.path.dirname(os.path.abspath(path)))
+            os.close(handle)
+            try:
+                # mkstemp only gives the owner access, keep the excel's permissions for everyone else
+                if os.path.exists(path):
+                    shutil.copymode(path, temp_path)
+                with zipfile.ZipFile(temp_path, 'w') as output:
+                    for info in self.archive.infolist():
+                        output.writestr(info, changed.get(info.filename, None) or self.archive.read(info.filename))
+            except Exception:
+                os.remove(temp_path)
+                raise
+            self.archive.close()
+            os.replace(temp_path, path)
+        else:
+            self.archive.close()